@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QCoreApplication
+
+from qgis.core import (NULL, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsFeature,
+                        QgsFeatureSink, QgsFields, QgsProcessing, QgsProcessingAlgorithm, QgsProcessingException,
+                        QgsProcessingOutputNumber, QgsProcessingOutputVectorLayer, QgsProcessingParameterEnum,
+                        QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource, QgsProcessingParameterField,
+                        QgsProcessingParameterNumber, QgsProcessingParameterVectorLayer, QgsWkbTypes)
+
+from . import settings
+from .columns import RESULT_TYPES, REVERSE_RESULT_COLUMNS, filterColumns
+
+class GbanAlgorithm(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    CHUNK_SIZE = 'CHUNK_SIZE'
+    AREAS = 'AREAS'
+    AREA_POSTCODE_FIELD = 'AREA_POSTCODE_FIELD'
+    AREA_CITYCODE_FIELD = 'AREA_CITYCODE_FIELD'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, message):
+        return QCoreApplication.translate('Gban', message)
+
+    def createInstance(self):
+        return type(self)()
+
+    def chunkSizeParameter(self):
+        return QgsProcessingParameterNumber(self.CHUNK_SIZE, self.tr("Rows per request"), QgsProcessingParameterNumber.Integer,
+                                            settings.DEFAULTS['batch/chunkSize'], minValue=1, maxValue=50000)
+
+    def areaParameters(self):
+        ''' optional reference polygons restricting the first request of the rows they contain
+        '''
+        self.addParameter(QgsProcessingParameterFeatureSource(self.AREAS, self.tr("Reference areas"), [QgsProcessing.TypeVectorPolygon],
+                                                              optional=True))
+        self.addParameter(QgsProcessingParameterField(self.AREA_POSTCODE_FIELD, self.tr("Area postcode field"),
+                                                      parentLayerParameterName=self.AREAS, optional=True))
+        self.addParameter(QgsProcessingParameterField(self.AREA_CITYCODE_FIELD, self.tr("Area citycode field"),
+                                                      parentLayerParameterName=self.AREAS, optional=True))
+
+    def referenceAreas(self, parameters, context, crs):
+        from .areas import ReferenceAreas
+        areas = self.parameterAsSource(parameters, self.AREAS, context)
+        fieldNames = filterColumns(self.parameterAsString(parameters, self.AREA_POSTCODE_FIELD, context),
+                                   self.parameterAsString(parameters, self.AREA_CITYCODE_FIELD, context))
+        if areas is None or not fieldNames:
+            return None
+        return ReferenceAreas(areas, fieldNames, crs, context.transformContext())
+
+    def openJournal(self, parameters, context, geocoder, source, areas=None):
+        ''' journal of the job, an interrupted run on the same input with the same parameters resumes from it
+        '''
+        from .batch import layerSignature, openJournal
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        signature = layerSignature(layer) if layer is not None else {"source": self.parameterAsString(parameters, self.INPUT, context)}
+        signature.update(geocoder.signature(), crs=source.sourceCrs().authid(), count=source.featureCount())
+        if areas is not None:
+            signature.update(areas.signature())
+        return openJournal(signature, source.featureCount())
+
+    def finish(self, feedback, geocoder, journal):
+        from .batch import closeJournal
+        closeJournal(journal, not feedback.isCanceled())
+        feedback.pushInfo(self.tr("{} rows geocoded, {} distinct queries sent").format(geocoder.coalescer.rows, geocoder.coalescer.requests))
+        if geocoder.requeries():
+            feedback.pushInfo(self.tr("{} low score queries sent again, {} still below the minimum score").format(
+                geocoder.requeried, geocoder.lowScores))
+        if journal is not None:
+            feedback.pushInfo(journal.summary())
+
+class GeocodeLayerAlgorithm(GbanAlgorithm):
+
+    FIELDS = 'FIELDS'
+    MIN_SCORE = 'MIN_SCORE'
+    POSTCODE_FIELD = 'POSTCODE_FIELD'
+    CITYCODE_FIELD = 'CITYCODE_FIELD'
+    RETRY_TYPE = 'RETRY_TYPE'
+
+    def name(self):
+        return 'geocodelayer'
+
+    def displayName(self):
+        return self.tr("Geocode layer")
+
+    def shortHelpString(self):
+        return self.tr("Geocodes the features of a layer with the geocoder chosen in the plugin settings. The address is built from the selected fields, "
+                       "the output point layer has the input attributes followed by the result columns.\n"
+                       "Results scoring below the minimum score are sent again, restricted to the postcode or citycode of their row "
+                       "or to a type of result. result_quality tells whether a result was ok, improved by this second pass (requeried) "
+                       "or is still below the minimum score (low).")
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT, self.tr("Input layer"), [QgsProcessing.TypeVector]))
+        self.addParameter(QgsProcessingParameterField(self.FIELDS, self.tr("Address fields"), parentLayerParameterName=self.INPUT,
+                                                      allowMultiple=True))
+        self.addParameter(self.chunkSizeParameter())
+        self.addParameter(QgsProcessingParameterNumber(self.MIN_SCORE, self.tr("Minimum score"), QgsProcessingParameterNumber.Double,
+                                                       settings.DEFAULTS['batch/minScore'], minValue=0, maxValue=1))
+        self.addParameter(QgsProcessingParameterField(self.POSTCODE_FIELD, self.tr("Second pass postcode field"),
+                                                      parentLayerParameterName=self.INPUT, optional=True))
+        self.addParameter(QgsProcessingParameterField(self.CITYCODE_FIELD, self.tr("Second pass citycode field"),
+                                                      parentLayerParameterName=self.INPUT, optional=True))
+        self.addParameter(QgsProcessingParameterEnum(self.RETRY_TYPE, self.tr("Second pass result type"),
+                                                     [resultType or self.tr("Any") for resultType in RESULT_TYPES], defaultValue=0))
+        self.areaParameters()
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr("Geocoded"), QgsProcessing.TypeVectorPoint))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        from . import backends
+        from .areas import featureRequest
+        from .batch import BatchError, closeJournal, geocodedFeatures, resultField
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        columns = self.parameterAsFields(parameters, self.FIELDS, context)
+        if not columns:
+            raise QgsProcessingException(self.tr("At least one address field is required"))
+        filters = filterColumns(self.parameterAsString(parameters, self.POSTCODE_FIELD, context),
+                                self.parameterAsString(parameters, self.CITYCODE_FIELD, context))
+        areas = self.referenceAreas(parameters, context, source.sourceCrs())
+        geocoder = backends.fromSettings().batchGeocoder(columns, self.parameterAsInt(parameters, self.CHUNK_SIZE, context), filters,
+                                                         self.parameterAsDouble(parameters, self.MIN_SCORE, context),
+                                                         RESULT_TYPES[self.parameterAsEnum(parameters, self.RETRY_TYPE, context)],
+                                                         areas.filters() if areas is not None else None)
+
+        fields = QgsFields(source.fields())
+        for column in geocoder.outputColumns():
+            fields.append(resultField(column))
+        sink, destination = self.parameterAsSink(parameters, self.OUTPUT, context, fields, QgsWkbTypes.Point,
+                                                 QgsCoordinateReferenceSystem("EPSG:4326"))
+
+        indices = [source.fields().lookupField(column) for column in geocoder.inputColumns()]
+        features = source.getFeatures(featureRequest(areas))
+        total = 100.0 / source.featureCount() if source.featureCount() else 0
+        journal = self.openJournal(parameters, context, geocoder, source, areas)
+        try:
+            for count, feature in enumerate(geocodedFeatures(geocoder, features, indices, fields, feedback.isCanceled, journal, areas), 1):
+                sink.addFeature(feature, QgsFeatureSink.FastInsert)
+                feedback.setProgress(count * total)
+        except BatchError as e:
+            closeJournal(journal, False)
+            raise QgsProcessingException(str(e))
+        self.finish(feedback, geocoder, journal)
+        return {self.OUTPUT: destination}
+
+class IncrementalGeocodeLayerAlgorithm(GbanAlgorithm):
+
+    FIELDS = 'FIELDS'
+    GEOCODED = 'GEOCODED'
+
+    def name(self):
+        return 'geocodelayerincremental'
+
+    def displayName(self):
+        return self.tr("Geocode layer in place")
+
+    def shortHelpString(self):
+        return self.tr("Writes the results of the geocoder chosen in the plugin settings to the layer itself. A hash of the address fields "
+                       "is stored next to the results, only the features whose address changed since the last run, the new ones and "
+                       "those without result are sent. Results are written chunk by chunk, an interrupted run goes on where it stopped.")
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterVectorLayer(self.INPUT, self.tr("Input layer"), [QgsProcessing.TypeVector]))
+        self.addParameter(QgsProcessingParameterField(self.FIELDS, self.tr("Address fields"), parentLayerParameterName=self.INPUT,
+                                                      allowMultiple=True))
+        self.addParameter(self.chunkSizeParameter())
+        self.areaParameters()
+        self.addOutput(QgsProcessingOutputVectorLayer(self.OUTPUT, self.tr("Geocoded")))
+        self.addOutput(QgsProcessingOutputNumber(self.GEOCODED, self.tr("Geocoded features")))
+
+    def flags(self):
+        # The layer is modified through its provider, from the main thread
+        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading
+
+    def processAlgorithm(self, parameters, context, feedback):
+        from . import backends
+        from .areas import featureRequest
+        from .batch import BatchError
+        from .incremental import addResultFields, geocodeStale
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        columns = self.parameterAsFields(parameters, self.FIELDS, context)
+        if not columns:
+            raise QgsProcessingException(self.tr("At least one address field is required"))
+        chunkSize = self.parameterAsInt(parameters, self.CHUNK_SIZE, context)
+        areas = self.referenceAreas(parameters, context, layer.crs())
+        geocoder = backends.fromSettings().batchGeocoder(columns, chunkSize, areaFilters=areas.filters() if areas is not None else None)
+        try:
+            indices = addResultFields(layer, geocoder)
+        except BatchError as e:
+            raise QgsProcessingException(str(e))
+
+        features = layer.getFeatures(featureRequest(areas))
+        total = 100.0 / layer.featureCount() if layer.featureCount() else 0
+        changes = {}
+        count = 0
+        try:
+            for count, (rowId, values) in enumerate(geocodeStale(geocoder, features, layer.fields(), feedback.isCanceled, areas), 1):
+                changes[rowId] = dict(zip(indices, values))
+                if len(changes) >= chunkSize:
+                    layer.dataProvider().changeAttributeValues(changes)
+                    changes = {}
+                feedback.setProgress(count * total)
+        except BatchError as e:
+            raise QgsProcessingException(str(e))
+        finally:
+            # The hashes of the written results are the checkpoint of the next run
+            layer.dataProvider().changeAttributeValues(changes)
+            layer.triggerRepaint()
+        feedback.pushInfo(self.tr("{} features geocoded, {} distinct queries sent").format(count, geocoder.coalescer.requests))
+        return {self.OUTPUT: layer.id(), self.GEOCODED: count}
+
+class ReverseGeocodeLayerAlgorithm(GbanAlgorithm):
+
+    TOLERANCE = 'TOLERANCE'
+
+    def name(self):
+        return 'reversegeocodelayer'
+
+    def displayName(self):
+        return self.tr("Reverse geocode layer")
+
+    def shortHelpString(self):
+        return self.tr("Finds the nearest BAN address of every feature with the geocoder chosen in the plugin settings. "
+                       "The output layer has the input features with the address columns added.")
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT, self.tr("Input layer"), [QgsProcessing.TypeVectorAnyGeometry]))
+        self.addParameter(self.chunkSizeParameter())
+        self.addParameter(QgsProcessingParameterNumber(self.TOLERANCE, self.tr("Points closer than this distance (m) share their address"),
+                                                       QgsProcessingParameterNumber.Double, settings.DEFAULTS['batch/reverseTolerance'],
+                                                       minValue=0))
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr("Reverse geocoded")))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        from . import backends
+        from .batch import BatchError, closeJournal, resultField, resultValue, reverseRows
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        geocoder = backends.fromSettings().batchReverseGeocoder(self.parameterAsInt(parameters, self.CHUNK_SIZE, context),
+                                                                self.parameterAsDouble(parameters, self.TOLERANCE, context))
+
+        fields = QgsFields(source.fields())
+        for column in REVERSE_RESULT_COLUMNS:
+            fields.append(resultField(column))
+        sink, destination = self.parameterAsSink(parameters, self.OUTPUT, context, fields, source.wkbType(), source.sourceCrs())
+
+        transform = QgsCoordinateTransform(source.sourceCrs(), QgsCoordinateReferenceSystem("EPSG:4326"), context.transformContext())
+        # Features are kept until their chunk is answered, those without geometry are written as they come
+        pending = {}
+        def features():
+            for feature in source.getFeatures():
+                if feature.hasGeometry():
+                    pending[feature.id()] = feature
+                    yield feature
+                else:
+                    self.addFeature(sink, fields, feature, [NULL] * len(REVERSE_RESULT_COLUMNS))
+
+        total = 100.0 / source.featureCount() if source.featureCount() else 0
+        journal = self.openJournal(parameters, context, geocoder, source)
+        try:
+            for count, (rowId, result) in enumerate(geocoder.geocode(reverseRows(features(), transform), feedback.isCanceled, journal), 1):
+                values = [resultValue(column, result[column]) for column in REVERSE_RESULT_COLUMNS]
+                self.addFeature(sink, fields, pending.pop(rowId), values)
+                feedback.setProgress(count * total)
+        except BatchError as e:
+            closeJournal(journal, False)
+            raise QgsProcessingException(str(e))
+        self.finish(feedback, geocoder, journal)
+        return {self.OUTPUT: destination}
+
+    def addFeature(self, sink, fields, feature, values):
+        output = QgsFeature(fields)
+        output.setGeometry(feature.geometry())
+        output.setAttributes(feature.attributes() + values)
+        sink.addFeature(output, QgsFeatureSink.FastInsert)
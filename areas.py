@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from qgis.core import NULL, QgsFeatureRequest, QgsGeometry, QgsSpatialIndex
+
+import threading
+
+# Columns of the uploaded csv holding the filters found in the reference areas
+AREA_COLUMNS = {"postcode": "gban_area_postcode", "citycode": "gban_area_citycode"}
+
+class ReferenceAreas:
+    ''' postcode and citycode of the polygons of a reference layer (communes, postcode areas…), found for each
+        row from its geometry so that its first request is restricted to the area containing it.
+        fieldNames is {filter: field} and crs the CRS of the rows. The polygons are loaded in a spatial index
+        when built, from the main thread, then looked up from the task threads
+    '''
+
+    def __init__(self, source, fieldNames, crs, transformContext):
+        self.fieldNames = {name: field for name, field in fieldNames.items() if name in AREA_COLUMNS and field}
+        self.name = source.sourceName()
+        request = QgsFeatureRequest().setSubsetOfAttributes(list(self.fieldNames.values()), source.fields())
+        request.setDestinationCrs(crs, transformContext)
+        self.codes = {}
+        self.index = QgsSpatialIndex(flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+        for feature in source.getFeatures(request):
+            if feature.hasGeometry():
+                self.codes[feature.id()] = ['' if feature[field] == NULL else str(feature[field]) for field in self.fieldNames.values()]
+                self.index.addFeature(feature)
+        # Prepared geometries of the polygons already hit, several task threads may share them
+        self.engines = {}
+        self.lock = threading.Lock()
+
+    def filters(self):
+        ''' names of the filters found in the areas
+        '''
+        return list(self.fieldNames)
+
+    def signature(self):
+        return {"areas": self.name, "areaFields": self.fieldNames}
+
+    def engine(self, fid):
+        with self.lock:
+            if fid not in self.engines:
+                # The engine does not copy the polygon, it is kept with it
+                polygon = self.index.geometry(fid)
+                engine = QgsGeometry.createGeometryEngine(polygon.constGet())
+                engine.prepareGeometry()
+                self.engines[fid] = (polygon, engine)
+            return self.engines[fid][1]
+
+    def values(self, geometry):
+        ''' values of the filters of the area containing a geometry, empty ones outside every area
+        '''
+        if geometry is not None and not geometry.isNull():
+            point = geometry.pointOnSurface()
+            if not point.isNull():
+                for fid in self.index.intersects(point.boundingBox()):
+                    if self.engine(fid).contains(point.constGet()):
+                        return self.codes[fid]
+        return [''] * len(self.fieldNames)
+
+def constrain(values, feature, areas):
+    ''' the values of a row followed by those of the filters of its area
+    '''
+    return values if areas is None else values + areas.values(feature.geometry())
+
+def featureRequest(areas):
+    ''' request of the features to geocode, their geometry is only needed to find their area
+    '''
+    return QgsFeatureRequest() if areas is not None else QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
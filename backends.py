@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.core import Qgis, QgsMessageLog
+
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import time
+from urllib.parse import urlencode
+
+from . import settings
+from .batch import BatchGeocoder, BatchReverseGeocoder
+from .cache import reverseKey, searchKey
+from .columns import REVERSE_RESULT_COLUMNS
+from .network import Response
+from .offline import FILTERS, OfflineIndex
+from .stats import stats
+
+class Backend:
+    ''' geocoding engine. search and reverse are asynchronous: callback is called with a Response
+        and they return a handle with an abort method, or None when they answered right away.
+        The batch geocoders are meant to run in task threads
+    '''
+
+    def search(self, query, callback, **params):
+        raise NotImplementedError
+
+    def reverse(self, lon, lat, callback, **params):
+        raise NotImplementedError
+
+    def batchGeocoder(self, columns, chunkSize, filterColumns=None, minScore=0, retryType="", areaFilters=None):
+        raise NotImplementedError
+
+    def batchReverseGeocoder(self, chunkSize, tolerance=0, resultColumns=REVERSE_RESULT_COLUMNS):
+        raise NotImplementedError
+
+    def close(self):
+        ''' release the files held by the backend
+        '''
+        pass
+
+class AddokBackend(Backend):
+    ''' addok HTTP API, the public BAN API or a self-hosted instance
+    '''
+
+    def __init__(self, url, queue=None):
+        self.url = url.rstrip('/')
+        self.queue = queue
+
+    def search(self, query, callback, **params):
+        return self.queue.get(self.url + "/search/?" + urlencode(dict(params, q=query)), callback)
+
+    def reverse(self, lon, lat, callback, **params):
+        return self.queue.get(self.url + "/reverse/?" + urlencode(dict(params, lon=lon, lat=lat)), callback)
+
+    def batchGeocoder(self, columns, chunkSize, filterColumns=None, minScore=0, retryType="", areaFilters=None):
+        return BatchGeocoder(columns, chunkSize, self.url + "/search/csv/", filterColumns=filterColumns, minScore=minScore,
+                             retryType=retryType, areaFilters=areaFilters)
+
+    def batchReverseGeocoder(self, chunkSize, tolerance=0, resultColumns=REVERSE_RESULT_COLUMNS):
+        return BatchReverseGeocoder(chunkSize, tolerance, self.url + "/reverse/csv/", resultColumns)
+
+class CachedBackend(Backend):
+    ''' answer from the persistent cache when possible, otherwise ask the wrapped backend and store its answer
+    '''
+
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+
+    def cached(self, key, callback, request):
+        content = self.cache.get(key)
+        stats.recordCache(content is not None)
+        if content is not None:
+            callback(Response(content, 200))
+            return None
+        def store(response):
+            if response.error is None:
+                self.cache.put(key, response.content)
+            callback(response)
+        return request(store)
+
+    def search(self, query, callback, **params):
+        return self.cached(searchKey(query, **params), callback, lambda store: self.backend.search(query, store, **params))
+
+    def reverse(self, lon, lat, callback, **params):
+        key = reverseKey(lon, lat, settings.value('cache/reversePrecision'))
+        return self.cached(key, callback, lambda store: self.backend.reverse(lon, lat, store, **params))
+
+    def batchGeocoder(self, columns, chunkSize, filterColumns=None, minScore=0, retryType="", areaFilters=None):
+        return self.backend.batchGeocoder(columns, chunkSize, filterColumns, minScore, retryType, areaFilters)
+
+    def batchReverseGeocoder(self, chunkSize, tolerance=0, resultColumns=REVERSE_RESULT_COLUMNS):
+        return self.backend.batchReverseGeocoder(chunkSize, tolerance, resultColumns)
+
+    def close(self):
+        self.backend.close()
+
+def csvResult(feature):
+    ''' convert a GeoJSON feature to the result columns of the BAN csv endpoints
+    '''
+    properties = feature["properties"]
+    lon, lat = feature["geometry"]["coordinates"]
+    result = {"longitude": str(lon), "latitude": str(lat), "result_score": str(properties["score"])}
+    for name in ("label", "type", "housenumber", "street", "postcode", "city", "citycode"):
+        result["result_" + name] = properties.get(name) or ""
+    return result
+
+class OfflineMatcher:
+    ''' match the rows of a chunk in the calling thread, or in worker processes for large chunks
+        when more than one process is allowed
+    '''
+
+    def __init__(self, backend, processes=1):
+        self.backend = backend
+        self.processes = processes
+        self.executor = None
+
+    def match(self, function, rows):
+        # The executor module imports NumPy and the workers, it is only imported when needed
+        from . import executor
+        if self.processes != 1 and len(rows) >= executor.MIN_ROWS:
+            if self.executor is None:
+                # Open the index here first, an old one is migrated before the workers open it
+                self.backend.index()
+                self.executor = executor.ShardExecutor(self.backend.path, self.processes)
+            try:
+                return self.executor.map(getattr(executor, function), rows)
+            except (BrokenProcessPool, OSError) as e:
+                QgsMessageLog.logMessage("Worker processes unavailable, matching in a single process: {}".format(e), 'Gban', Qgis.Warning)
+                self.close()
+                self.processes = 1
+        return getattr(executor, function)(rows, self.backend.index())
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.close()
+            self.executor = None
+
+class OfflineBatchGeocoder(BatchGeocoder):
+    ''' the type filter is not supported by the offline index, only the postcode and citycode ones
+    '''
+
+    def __init__(self, backend, columns, chunkSize, filterColumns=None, minScore=0, retryType="", processes=1, areaFilters=None):
+        super().__init__(columns, chunkSize, backend.path, filterColumns=filterColumns, minScore=minScore, retryType=retryType,
+                         areaFilters=areaFilters)
+        self.matcher = OfflineMatcher(backend, processes)
+
+    def requeries(self):
+        return self.minScore > 0 and bool(self.filterColumns)
+
+    def geocodeChunk(self, chunk, requery=False):
+        inputColumns = self.inputColumns()
+        rows = []
+        for rowId, values in chunk:
+            if requery:
+                filters = {name: values[inputColumns.index(column)] for name, column in self.filterColumns.items()
+                           if name in FILTERS and values[inputColumns.index(column)]}
+            else:
+                filters = {name: value for name, value in zip(self.areaFilters, values[len(inputColumns):]) if value}
+            rows.append((' '.join(values[:len(self.columns)]), filters))
+        features = self.matcher.match('search', rows)
+        return [(rowId, csvResult(feature) if feature else {}) for (rowId, values), feature in zip(chunk, features)]
+
+    def geocode(self, rows, isCanceled=lambda: False, journal=None):
+        try:
+            yield from super().geocode(rows, isCanceled, journal)
+        finally:
+            self.matcher.close()
+
+class OfflineBatchReverseGeocoder(BatchReverseGeocoder):
+
+    def __init__(self, backend, chunkSize, tolerance=0, processes=1, resultColumns=REVERSE_RESULT_COLUMNS):
+        super().__init__(chunkSize, tolerance, backend.path, resultColumns)
+        self.matcher = OfflineMatcher(backend, processes)
+
+    def geocodeChunk(self, chunk, requery=False):
+        features = self.matcher.match('reverse', [(float(lon), float(lat)) for rowId, (lon, lat) in chunk])
+        return [(rowId, csvResult(feature) if feature else {}) for (rowId, values), feature in zip(chunk, features)]
+
+    def geocode(self, rows, isCanceled=lambda: False, journal=None):
+        try:
+            yield from super().geocode(rows, isCanceled, journal)
+        finally:
+            self.matcher.close()
+
+class OfflineBackend(Backend):
+    ''' local index of BAN addresses, see offline.py, or compact address store, see columnar.py
+    '''
+
+    def __init__(self, path, processes=1):
+        self.path = path
+        self.processes = processes
+        # sqlite connections can not be shared between threads, each one opens the index
+        self.local = threading.local()
+        # The address store is read only, all the threads share its memory map
+        self.store = None
+        self.lock = threading.Lock()
+
+    def index(self):
+        # NumPy is only imported once an address store is used
+        from .columnar import SUFFIX, ColumnarIndex
+        if self.path.endswith(SUFFIX):
+            with self.lock:
+                if self.store is None:
+                    self.store = ColumnarIndex(self.path)
+            return self.store
+        if not hasattr(self.local, 'index'):
+            self.local.index = OfflineIndex(self.path)
+        return self.local.index
+
+    def close(self):
+        # The address store can not be replaced on Windows while it is mapped
+        with self.lock:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
+
+    def search(self, query, callback, limit=5, **params):
+        # Only the filters are supported, the other parameters only tune the ranking of the API
+        filters = {name: value for name, value in params.items() if name in FILTERS}
+        started = time.monotonic()
+        data = self.index().search(query, limit, **filters)
+        stats.record('offline', time.monotonic() - started)
+        callback(Response(data=data))
+
+    def reverse(self, lon, lat, callback, limit=1, **params):
+        started = time.monotonic()
+        data = self.index().reverse(lon, lat, limit)
+        stats.record('offline', time.monotonic() - started)
+        callback(Response(data=data))
+
+    def batchGeocoder(self, columns, chunkSize, filterColumns=None, minScore=0, retryType="", areaFilters=None):
+        return OfflineBatchGeocoder(self, columns, chunkSize, filterColumns, minScore, retryType, self.processes, areaFilters)
+
+    def batchReverseGeocoder(self, chunkSize, tolerance=0, resultColumns=REVERSE_RESULT_COLUMNS):
+        return OfflineBatchReverseGeocoder(self, chunkSize, tolerance, self.processes, resultColumns)
+
+def fromSettings(queue=None, cache=None):
+    ''' build the backend chosen in the settings, online results are cached when a cache is given
+    '''
+    if settings.value('engine') == 'offline':
+        return OfflineBackend(settings.offlinePath(), settings.value('offline/processes'))
+    backend = AddokBackend(settings.value('network/url'), queue)
+    if cache is not None and settings.value('cache/enabled'):
+        backend = CachedBackend(backend, cache)
+    return backend
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QByteArray, QUrl, QVariant, pyqtSignal
+from qgis.PyQt.QtNetwork import QNetworkRequest
+
+from qgis.core import (NULL, Qgis, QgsBlockingNetworkRequest, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsCsException,
+                        QgsFeature, QgsFeatureRequest, QgsField, QgsFields, QgsGeometry, QgsMessageLog, QgsPointXY, QgsProject,
+                        QgsTask, QgsVectorDataProvider, QgsVectorLayer, QgsVectorLayerFeatureSource)
+
+import csv
+import io
+import os
+import time
+import uuid
+
+from . import settings
+from .areas import AREA_COLUMNS, constrain, featureRequest
+from .columns import RESULT_COLUMNS, REVERSE_RESULT_COLUMNS
+from .dedup import Coalescer, ReverseKey, searchKey
+from .journal import Journal, jobName
+from .network import limiter, retryDelay, shouldRetry
+from .parsing import readCsv
+from .resultlayer import memoryLayer
+from .stats import stats
+from .transforms import transformPoints
+
+# Column added to every uploaded chunk so that results can be matched back to their row
+ID_COLUMN = "gban_id"
+
+NUMERIC_COLUMNS = ("longitude", "latitude", "result_score")
+
+# Match quality of a result: ok, requeried (improved by the second pass) or low (to be reviewed)
+QUALITY_COLUMN = "result_quality"
+# Column of the uploaded csv holding the type filter of the second pass
+TYPE_COLUMN = "gban_type"
+
+class BatchError(Exception):
+    pass
+
+def resultField(column):
+    return QgsField(column, QVariant.Double if column in NUMERIC_COLUMNS else QVariant.String)
+
+def resultValue(column, value):
+    ''' convert a csv result value to an attribute value
+    '''
+    if not value:
+        return NULL
+    return float(value) if column in NUMERIC_COLUMNS else value
+
+def buildCsv(rows, columns):
+    ''' build the csv payload of a chunk of (id, values) rows
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([ID_COLUMN] + columns)
+    for rowId, values in rows:
+        writer.writerow([rowId] + values)
+    return buffer.getvalue().encode('utf-8')
+
+def buildMultipart(fields, files):
+    ''' encode form fields and (name, filename, content) files as multipart/form-data
+    '''
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields:
+        body.write('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value).encode('utf-8'))
+    for name, filename, content in files:
+        body.write('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: text/csv\r\n\r\n'.format(boundary, name, filename).encode('utf-8'))
+        body.write(content)
+        body.write(b'\r\n')
+    body.write('--{}--\r\n'.format(boundary).encode('utf-8'))
+    return 'multipart/form-data; boundary=' + boundary, body.getvalue()
+
+def post(url, contentType, body):
+    ''' send a blocking POST request, meant to be called from a task thread,
+        throttled responses are retried with backoff
+    '''
+    request = QNetworkRequest(QUrl(url))
+    request.setHeader(QNetworkRequest.ContentTypeHeader, contentType)
+    request.setRawHeader(b'Connection', b'keep-alive')
+    attempt = 0
+    while True:
+        limiter.acquire()
+        blocking = QgsBlockingNetworkRequest()
+        started = time.monotonic()
+        error = blocking.post(request, QByteArray(body))
+        reply = blocking.reply()
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if error == QgsBlockingNetworkRequest.NoError:
+            content = bytes(reply.content())
+            stats.record(url, time.monotonic() - started, len(content), status, attempt)
+            return content
+        if not shouldRetry(status, attempt):
+            stats.record(url, time.monotonic() - started, 0, status, attempt, blocking.errorMessage())
+            raise BatchError(blocking.errorMessage())
+        time.sleep(retryDelay(attempt, bytes(reply.rawHeader(b'Retry-After')).decode('latin-1')))
+        attempt += 1
+
+class BatchGeocoder:
+    ''' geocode rows through the BAN csv endpoint, chunk by chunk, keeping the input order.
+        When minScore is set, the results below it are flagged and, given filterColumns ({filter: column})
+        or a retryType, sent again restricted with these filters.
+        areaFilters are the filters found in reference areas (see areas.py), their values follow those
+        of the input columns and restrict every request
+    '''
+
+    def __init__(self, columns, chunkSize, url, resultColumns=RESULT_COLUMNS, post=post, key=searchKey,
+                 filterColumns=None, minScore=0, retryType="", areaFilters=None):
+        self.columns = columns
+        self.chunkSize = chunkSize
+        self.url = url
+        self.resultColumns = resultColumns
+        self.post = post
+        self.coalescer = Coalescer(key)
+        self.filterColumns = dict(filterColumns or {})
+        self.minScore = minScore
+        self.retryType = retryType
+        self.areaFilters = list(areaFilters or [])
+        self.requeried = 0
+        self.lowScores = 0
+
+    def inputColumns(self):
+        ''' columns of the values of the rows: the address columns followed by the filter columns
+        '''
+        return self.columns + [column for column in dict.fromkeys(self.filterColumns.values()) if column not in self.columns]
+
+    def areaColumns(self):
+        ''' columns of the area filters, they follow the input columns in the values of the rows
+        '''
+        return [AREA_COLUMNS[name] for name in self.areaFilters]
+
+    def outputColumns(self):
+        return self.resultColumns + [QUALITY_COLUMN]
+
+    def requeries(self):
+        return self.minScore > 0 and bool(self.filterColumns or self.retryType)
+
+    def formFields(self, requery=False):
+        fields = [('columns', column) for column in self.columns]
+        if requery:
+            fields += list(self.filterColumns.items())
+            if self.retryType:
+                fields.append(('type', TYPE_COLUMN))
+        else:
+            fields += [(name, AREA_COLUMNS[name]) for name in self.areaFilters]
+        return fields + [('result_columns', column) for column in self.resultColumns]
+
+    def geocodeChunk(self, chunk, requery=False):
+        columns = self.inputColumns() + self.areaColumns()
+        if requery and self.retryType:
+            # The type filter of the csv endpoint is read from a column too
+            columns = columns + [TYPE_COLUMN]
+            chunk = [(rowId, values + [self.retryType]) for rowId, values in chunk]
+        contentType, body = buildMultipart(self.formFields(requery), [('data', 'chunk.csv', buildCsv(chunk, columns))])
+        results = readCsv(self.post(self.url, contentType, body), ID_COLUMN, self.resultColumns)
+        if len(results) != len(chunk):
+            raise BatchError("Expected {} rows in response, got {}".format(len(chunk), len(results)))
+        try:
+            return [(rowId, results[str(rowId)]) for rowId, values in chunk]
+        except KeyError as e:
+            raise BatchError("Row {} is missing from response".format(e))
+
+    def quality(self, result):
+        if not result.get("result_score"):
+            return ""
+        return "ok" if float(result["result_score"]) >= self.minScore else "low"
+
+    def outsideFilters(self, values, result):
+        ''' whether the result lies outside the postcode or citycode of the row values
+        '''
+        columns = self.inputColumns()
+        for name, column in self.filterColumns.items():
+            expected, found = values[columns.index(column)], result.get("result_" + name)
+            if expected and found and found != expected:
+                return True
+        return False
+
+    def keeps(self, values, previous, result):
+        ''' whether the filtered result of the second pass replaces the first one, which scored below minScore:
+            it scores at least as well, or the first one lies outside the filters of the row
+        '''
+        if not result.get("result_score"):
+            return False
+        return float(result["result_score"]) >= float(previous["result_score"] or 0) or self.outsideFilters(values, previous)
+
+    def answer(self, requests):
+        ''' geocode the {key: values} requests of a chunk and return {key: result}. Those scoring below minScore
+            are sent again with the filters as a smaller batch, their new result is kept when it does not score worse
+            or matches the filters when the first one did not
+        '''
+        keys = list(requests)
+        answers = {}
+        for index, result in self.geocodeChunk(list(enumerate(requests.values()))):
+            result = {column: result.get(column, "") for column in self.resultColumns}
+            result[QUALITY_COLUMN] = self.quality(result)
+            answers[keys[index]] = result
+        if self.requeries():
+            low = [key for key in keys if answers[key][QUALITY_COLUMN] != "ok"]
+            if low:
+                self.requeried += len(low)
+                for index, result in self.geocodeChunk([(index, requests[key]) for index, key in enumerate(low)], True):
+                    if self.keeps(requests[low[index]], answers[low[index]], result):
+                        result = {column: result.get(column, "") for column in self.resultColumns}
+                        result[QUALITY_COLUMN] = "requeried" if self.quality(result) == "ok" else "low"
+                        answers[low[index]] = result
+        self.lowScores += sum(1 for result in answers.values() if result[QUALITY_COLUMN] == "low")
+        return answers
+
+    def signature(self):
+        ''' everything that defines the chunks and their answers, used to identify a job journal
+        '''
+        return {"url": self.url, "columns": self.columns, "chunkSize": self.chunkSize, "resultColumns": self.resultColumns,
+                "filterColumns": self.filterColumns, "minScore": self.minScore, "retryType": self.retryType,
+                "areaFilters": self.areaFilters}
+
+    def geocode(self, rows, isCanceled=lambda: False, journal=None):
+        ''' yield (id, result) for every (id, values) row, in input order,
+            rows with the same key are only sent once.
+            The answers of the chunks already committed in the journal are replayed
+        '''
+        for number, (chunk, requests) in enumerate(self.coalescer.chunks(rows, self.chunkSize)):
+            if isCanceled():
+                return
+            keys = list(requests)
+            replayed = journal.answers(number) if journal is not None else None
+            if replayed is not None:
+                answers = dict(zip(keys, replayed))
+            else:
+                answers = self.answer(requests) if keys else {}
+                if journal is not None:
+                    journal.commit(number, len(chunk), [answers[key] for key in keys])
+            for result in self.coalescer.fanOut(chunk, answers):
+                yield result
+
+class BatchReverseGeocoder(BatchGeocoder):
+    ''' reverse geocode (id, [lon, lat]) rows through the BAN reverse csv endpoint
+    '''
+
+    def __init__(self, chunkSize, tolerance, url, resultColumns=REVERSE_RESULT_COLUMNS, post=post):
+        super().__init__(["lon", "lat"], chunkSize, url, resultColumns, post, ReverseKey(tolerance))
+        self.tolerance = tolerance
+
+    def signature(self):
+        return dict(super().signature(), tolerance=self.tolerance)
+
+    def formFields(self, requery=False):
+        return [('result_columns', column) for column in self.resultColumns]
+
+def geocodedFeatures(geocoder, features, indices, fields, isCanceled=lambda: False, journal=None, areas=None):
+    ''' geocode features on the address fields at indices and yield point features
+        with their attributes followed by the result columns
+    '''
+    attributes = {}
+    def rows():
+        for feature in features:
+            attributes[feature.id()] = feature.attributes()
+            yield feature.id(), constrain(['' if feature[i] == NULL else str(feature[i]) for i in indices], feature, areas)
+    for rowId, result in geocoder.geocode(rows(), isCanceled, journal):
+        feature = QgsFeature(fields)
+        if result["longitude"] and result["latitude"]:
+            point = QgsPointXY(float(result["longitude"]), float(result["latitude"]))
+            feature.setGeometry(QgsGeometry.fromPointXY(point))
+        feature.setAttributes(attributes.pop(rowId) + [resultValue(column, result[column]) for column in geocoder.outputColumns()])
+        yield feature
+
+def layerSignature(layer):
+    return {"source": layer.source(), "provider": layer.providerType(), "subset": layer.subsetString(),
+            "count": layer.featureCount()}
+
+def openJournal(signature, total):
+    ''' open the journal of a job in the profile directory, progress is logged at every committed chunk
+    '''
+    if not settings.value('batch/journal'):
+        return None
+    journal = Journal(settings.profilePath(os.path.join('jobs', jobName(signature))), signature, total,
+                      lambda journal: QgsMessageLog.logMessage(journal.summary(), 'Gban', Qgis.Info))
+    if journal.resumedRows:
+        QgsMessageLog.logMessage("Resuming the job after {} rows already geocoded".format(journal.resumedRows), 'Gban', Qgis.Info)
+    return journal
+
+def closeJournal(journal, complete):
+    if journal is not None:
+        if complete:
+            journal.remove()
+        else:
+            journal.close()
+
+def reverseRows(features, transform, batchSize=1000):
+    ''' yield (id, [lon, lat]) rows from the features with a geometry, transform goes to EPSG:4326.
+        Points are transformed by batches of batchSize
+    '''
+    def rows(ids, points):
+        for rowId, point in zip(ids, transformPoints(points, transform)):
+            yield rowId, ["{:.7f}".format(point.x()), "{:.7f}".format(point.y())]
+    ids, points = [], []
+    for feature in features:
+        if feature.hasGeometry():
+            ids.append(feature.id())
+            points.append(feature.geometry().centroid().asPoint())
+            if len(points) == batchSize:
+                yield from rows(ids, points)
+                ids, points = [], []
+    yield from rows(ids, points)
+
+class BatchGeocodingTask(QgsTask):
+    ''' geocode the features of a layer in background and build a point layer from the results
+    '''
+
+    layerReady = pyqtSignal(QgsVectorLayer)
+    error = pyqtSignal(str)
+
+    def __init__(self, layer, columns, geocoder, areas=None):
+        super().__init__("Gban - " + layer.name(), QgsTask.CanCancel)
+        self.name = layer.name()
+        self.areas = areas
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.total = layer.featureCount()
+        self.fields = QgsFields(layer.fields())
+        self.indices = [self.fields.indexOf(column) for column in geocoder.inputColumns()]
+        self.geocoder = geocoder
+        self.signature = dict(geocoder.signature(), **layerSignature(layer))
+        if areas is not None:
+            self.signature.update(areas.signature())
+        self.outputFields = QgsFields(self.fields)
+        for column in geocoder.outputColumns():
+            self.outputFields.append(resultField(column))
+        self.features = []
+        self.exception = None
+
+    def run(self):
+        features = self.source.getFeatures(featureRequest(self.areas))
+        journal = openJournal(self.signature, self.total)
+        complete = False
+        try:
+            for count, feature in enumerate(geocodedFeatures(self.geocoder, features, self.indices, self.outputFields,
+                                                             self.isCanceled, journal, self.areas), 1):
+                self.features.append(feature)
+                self.setProgress(100 * count / max(self.total, 1))
+            complete = not self.isCanceled()
+        except BatchError as e:
+            self.exception = e
+        finally:
+            closeJournal(journal, complete)
+        return complete
+
+    def finished(self, result):
+        if not result:
+            if self.exception is not None:
+                self.error.emit(str(self.exception))
+            return
+        if self.geocoder.requeries():
+            QgsMessageLog.logMessage("{} low score queries sent again, {} still below the minimum score".format(
+                self.geocoder.requeried, self.geocoder.lowScores), 'Gban', Qgis.Info)
+        layer = memoryLayer(self.name + " - Gban", self.outputFields.toList())
+        layer.dataProvider().addFeatures(self.features)
+        layer.updateExtents()
+        self.layerReady.emit(layer)
+
+class BatchReverseGeocodingTask(QgsTask):
+    ''' reverse geocode the points of a layer in background and write the addresses to its features
+    '''
+
+    error = pyqtSignal(str)
+
+    def __init__(self, layer, geocoder):
+        super().__init__("Gban - " + layer.name(), QgsTask.CanCancel)
+        self.layerId = layer.id()
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.total = layer.featureCount()
+        self.transform = QgsCoordinateTransform(layer.crs(), QgsCoordinateReferenceSystem(4326), QgsProject.instance())
+        self.geocoder = geocoder
+        self.signature = dict(geocoder.signature(), crs=layer.crs().authid(), **layerSignature(layer))
+        self.results = {}
+        self.exception = None
+
+    def run(self):
+        rows = reverseRows(self.source.getFeatures(QgsFeatureRequest().setNoAttributes()), self.transform)
+        journal = openJournal(self.signature, self.total)
+        complete = False
+        try:
+            for count, (rowId, result) in enumerate(self.geocoder.geocode(rows, self.isCanceled, journal), 1):
+                self.results[rowId] = [resultValue(column, result[column]) for column in REVERSE_RESULT_COLUMNS]
+                self.setProgress(100 * count / max(self.total, 1))
+            complete = not self.isCanceled()
+        except (BatchError, QgsCsException) as e:
+            self.exception = e
+        finally:
+            closeJournal(journal, complete)
+        return complete
+
+    def finished(self, result):
+        if not result:
+            if self.exception is not None:
+                self.error.emit(str(self.exception))
+            return
+        layer = QgsProject.instance().mapLayer(self.layerId)
+        if layer is None:
+            return
+        provider = layer.dataProvider()
+        capabilities = QgsVectorDataProvider.AddAttributes | QgsVectorDataProvider.ChangeAttributeValues
+        if provider.capabilities() & capabilities != capabilities:
+            self.error.emit("The layer {} can not be modified".format(layer.name()))
+            return
+        missing = [column for column in REVERSE_RESULT_COLUMNS if provider.fields().indexOf(column) < 0]
+        provider.addAttributes([resultField(column) for column in missing])
+        layer.updateFields()
+        indices = [provider.fields().indexOf(column) for column in REVERSE_RESULT_COLUMNS]
+        provider.changeAttributeValues({rowId: dict(zip(indices, values)) for rowId, values in self.results.items()})
+        layer.triggerRepaint()
\ No newline at end of file
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtWidgets import QCheckBox, QComboBox, QDialog, QDialogButtonBox, QDoubleSpinBox, QFormLayout, QLineEdit, QSpinBox
+
+from qgis.core import QgsMapLayerProxyModel
+from qgis.gui import QgsCheckableComboBox, QgsFieldComboBox, QgsFileWidget, QgsMapLayerComboBox
+
+from . import settings
+from .batch import BatchError
+from .columns import RESULT_TYPES, filterColumns
+from .pipeline import fieldNames, layerNames
+
+def minScoreSpinBox(parent):
+    minScore = QDoubleSpinBox(parent)
+    minScore.setRange(0, 1)
+    minScore.setSingleStep(0.05)
+    minScore.setSpecialValueText(QCoreApplication.translate('Gban', "Disabled"))
+    minScore.setValue(settings.value('batch/minScore'))
+    return minScore
+
+def retryTypeComboBox(parent):
+    retryType = QComboBox(parent)
+    for resultType in RESULT_TYPES:
+        retryType.addItem(resultType or QCoreApplication.translate('Gban', "Any"), resultType)
+    retryType.setCurrentIndex(max(0, retryType.findData(settings.value('batch/retryType'))))
+    return retryType
+
+class BatchDialog(QDialog):
+    ''' choose a layer and the number of rows sent per request
+    '''
+
+    def __init__(self, title, filters, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(title)
+
+        self.layerCombo = QgsMapLayerComboBox(self)
+        self.layerCombo.setFilters(filters)
+
+        self.chunkSize = QSpinBox(self)
+        self.chunkSize.setRange(1, 50000)
+        self.chunkSize.setValue(settings.value('batch/chunkSize'))
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, parent=self)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+
+        self.form = QFormLayout(self)
+        self.form.addRow(self.tr("Layer"), self.layerCombo)
+        self.form.addRow(self.tr("Rows per request"), self.chunkSize)
+        self.form.addRow(self.buttons)
+
+    def tr(self, message):
+        return QCoreApplication.translate('Gban', message)
+
+    def layer(self):
+        return self.layerCombo.currentLayer()
+
+    def isValid(self):
+        return self.layer() is not None
+
+    def accept(self):
+        if self.isValid():
+            settings.setValue('batch/chunkSize', self.chunkSize.value())
+            super().accept()
+
+class BatchGeocodingDialog(BatchDialog):
+
+    def __init__(self, parent=None):
+        super().__init__(QCoreApplication.translate('Gban', "Batch geocoding"), QgsMapLayerProxyModel.VectorLayer, parent)
+
+        self.fieldsCombo = QgsCheckableComboBox(self)
+        self.form.insertRow(1, self.tr("Address fields"), self.fieldsCombo)
+
+        self.minScore = minScoreSpinBox(self)
+        self.postcodeCombo = QgsFieldComboBox(self)
+        self.postcodeCombo.setAllowEmptyFieldName(True)
+        self.citycodeCombo = QgsFieldComboBox(self)
+        self.citycodeCombo.setAllowEmptyFieldName(True)
+        self.retryType = retryTypeComboBox(self)
+        self.form.insertRow(3, self.tr("Minimum score"), self.minScore)
+        self.form.insertRow(4, self.tr("Second pass postcode field"), self.postcodeCombo)
+        self.form.insertRow(5, self.tr("Second pass citycode field"), self.citycodeCombo)
+        self.form.insertRow(6, self.tr("Second pass result type"), self.retryType)
+
+        # Rows located in a polygon of the reference layer are restricted to its postcode or citycode
+        self.areasCombo = QgsMapLayerComboBox(self)
+        self.areasCombo.setFilters(QgsMapLayerProxyModel.PolygonLayer)
+        self.areasCombo.setAllowEmptyLayer(True)
+        self.areasCombo.setLayer(None)
+        self.areaPostcodeCombo = QgsFieldComboBox(self)
+        self.areaPostcodeCombo.setAllowEmptyFieldName(True)
+        self.areaCitycodeCombo = QgsFieldComboBox(self)
+        self.areaCitycodeCombo.setAllowEmptyFieldName(True)
+        self.areasCombo.layerChanged.connect(self.updateAreaFields)
+        self.updateAreaFields(None)
+        self.form.insertRow(7, self.tr("Reference areas"), self.areasCombo)
+        self.form.insertRow(8, self.tr("Area postcode field"), self.areaPostcodeCombo)
+        self.form.insertRow(9, self.tr("Area citycode field"), self.areaCitycodeCombo)
+
+        # Results written to the layer itself, only the features changed since the last run are sent
+        self.incremental = QCheckBox(self.tr("Write the results to the layer, only geocode new, changed and failed features"), self)
+        self.incremental.setChecked(settings.value('batch/incremental'))
+        self.watchEdits = QCheckBox(self.tr("Geocode the features edited in the layer once saved"), self)
+        self.watchEdits.setChecked(settings.value('batch/watchEdits'))
+        self.watchEdits.setEnabled(self.incremental.isChecked())
+        self.incremental.toggled.connect(self.watchEdits.setEnabled)
+        self.form.insertRow(10, self.incremental)
+        self.form.insertRow(11, self.watchEdits)
+
+        self.layerCombo.layerChanged.connect(self.updateFields)
+        self.updateFields(self.layerCombo.currentLayer())
+
+    def updateFields(self, layer):
+        self.fieldsCombo.clear()
+        if layer is not None:
+            self.fieldsCombo.addItems(layer.fields().names())
+        self.postcodeCombo.setLayer(layer)
+        self.citycodeCombo.setLayer(layer)
+        self.postcodeCombo.setField("")
+        self.citycodeCombo.setField("")
+
+    def updateAreaFields(self, layer):
+        for combo in (self.areaPostcodeCombo, self.areaCitycodeCombo):
+            combo.setLayer(layer)
+            combo.setField("")
+            combo.setEnabled(layer is not None)
+
+    def columns(self):
+        return self.fieldsCombo.checkedItems()
+
+    def filterColumns(self):
+        return filterColumns(self.postcodeCombo.currentField(), self.citycodeCombo.currentField())
+
+    def areaLayer(self):
+        ''' the reference layer, when one of its fields is chosen
+        '''
+        return self.areasCombo.currentLayer() if self.areaFields() else None
+
+    def areaFields(self):
+        return filterColumns(self.areaPostcodeCombo.currentField(), self.areaCitycodeCombo.currentField())
+
+    def isValid(self):
+        return super().isValid() and len(self.columns()) > 0
+
+    def watches(self):
+        return self.incremental.isChecked() and self.watchEdits.isChecked()
+
+    def accept(self):
+        if self.isValid():
+            settings.setValue('batch/minScore', self.minScore.value())
+            settings.setValue('batch/retryType', self.retryType.currentData())
+            settings.setValue('batch/incremental', self.incremental.isChecked())
+            settings.setValue('batch/watchEdits', self.watchEdits.isChecked())
+        super().accept()
+
+class BatchReverseGeocodingDialog(BatchDialog):
+
+    def __init__(self, parent=None):
+        super().__init__(QCoreApplication.translate('Gban', "Batch reverse geocoding"), QgsMapLayerProxyModel.PointLayer, parent)
+
+class FileGeocodingDialog(QDialog):
+    ''' choose a csv file or a GeoPackage layer to geocode and the GeoPackage to write the results to
+    '''
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(self.tr("Geocode a file"))
+
+        self.inputFile = QgsFileWidget(self)
+        self.inputFile.setFilter(self.tr("CSV or GeoPackage (*.csv *.gpkg)"))
+        self.inputFile.fileChanged.connect(self.updateLayers)
+
+        self.layerCombo = QComboBox(self)
+        self.layerCombo.currentTextChanged.connect(self.updateFields)
+
+        self.fieldsCombo = QgsCheckableComboBox(self)
+        self.postcodeCombo = QComboBox(self)
+        self.citycodeCombo = QComboBox(self)
+        self.minScore = minScoreSpinBox(self)
+        self.retryType = retryTypeComboBox(self)
+
+        self.outputFile = QgsFileWidget(self)
+        self.outputFile.setStorageMode(QgsFileWidget.SaveFile)
+        self.outputFile.setFilter(self.tr("GeoPackage (*.gpkg)"))
+
+        self.outputLayer = QLineEdit("geocoded", self)
+
+        self.chunkSize = QSpinBox(self)
+        self.chunkSize.setRange(1, 50000)
+        self.chunkSize.setValue(settings.value('batch/chunkSize'))
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, parent=self)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+
+        form = QFormLayout(self)
+        form.addRow(self.tr("Input file"), self.inputFile)
+        form.addRow(self.tr("Layer"), self.layerCombo)
+        form.addRow(self.tr("Address fields"), self.fieldsCombo)
+        form.addRow(self.tr("Minimum score"), self.minScore)
+        form.addRow(self.tr("Second pass postcode field"), self.postcodeCombo)
+        form.addRow(self.tr("Second pass citycode field"), self.citycodeCombo)
+        form.addRow(self.tr("Second pass result type"), self.retryType)
+        form.addRow(self.tr("Output GeoPackage"), self.outputFile)
+        form.addRow(self.tr("Output layer"), self.outputLayer)
+        form.addRow(self.tr("Rows per request"), self.chunkSize)
+        form.addRow(self.buttons)
+
+    def tr(self, message):
+        return QCoreApplication.translate('Gban', message)
+
+    def updateLayers(self, path):
+        self.layerCombo.clear()
+        try:
+            self.layerCombo.addItems(layerNames(path))
+        except BatchError:
+            pass
+
+    def updateFields(self, layerName):
+        self.fieldsCombo.clear()
+        self.postcodeCombo.clear()
+        self.citycodeCombo.clear()
+        names = []
+        if layerName:
+            try:
+                names = fieldNames(self.inputPath(), layerName)
+            except BatchError:
+                pass
+        self.fieldsCombo.addItems(names)
+        self.postcodeCombo.addItems([""] + names)
+        self.citycodeCombo.addItems([""] + names)
+
+    def inputPath(self):
+        return self.inputFile.filePath()
+
+    def inputLayer(self):
+        return self.layerCombo.currentText()
+
+    def outputPath(self):
+        path = self.outputFile.filePath()
+        return path if not path or path.lower().endswith('.gpkg') else path + '.gpkg'
+
+    def columns(self):
+        return self.fieldsCombo.checkedItems()
+
+    def filterColumns(self):
+        return filterColumns(self.postcodeCombo.currentText(), self.citycodeCombo.currentText())
+
+    def isValid(self):
+        return bool(self.inputLayer() and self.columns() and self.outputPath() and self.outputLayer.text())
+
+    def accept(self):
+        if self.isValid():
+            settings.setValue('batch/chunkSize', self.chunkSize.value())
+            settings.setValue('batch/minScore', self.minScore.value())
+            settings.setValue('batch/retryType', self.retryType.currentData())
+            super().accept()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' mock of the BAN API for the benchmarks: /search/, /reverse/, /search/csv/ and /reverse/csv/
+    answered after a configurable latency, with a configurable error rate and number of features
+'''
+
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import argparse
+import csv
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+
+SEARCH_COLUMNS = ["latitude", "longitude", "result_label", "result_score", "result_type", "result_id", "result_housenumber",
+                  "result_name", "result_street", "result_postcode", "result_city", "result_context", "result_citycode"]
+
+def address(text):
+    ''' deterministic fake address in France for a query
+    '''
+    digest = hashlib.md5(text.encode('utf-8')).digest()
+    lon = -4.5 + 12.5 * digest[0] / 255 + digest[1] / 255e3
+    lat = 42.5 + 8.5 * digest[2] / 255 + digest[3] / 255e3
+    number = str(1 + digest[4] % 150)
+    postcode = "{:05d}".format(1000 + (digest[5] << 8 | digest[6]) % 94000)
+    return {
+        "label": "{} Rue {} {} Ville{}".format(number, digest.hex()[:6], postcode, digest[7]),
+        "score": round(0.4 + 0.6 * digest[8] / 255, 4),
+        "type": "housenumber",
+        "id": postcode + "_" + digest.hex()[:8],
+        "housenumber": number,
+        "name": "{} Rue {}".format(number, digest.hex()[:6]),
+        "street": "Rue " + digest.hex()[:6],
+        "postcode": postcode,
+        "city": "Ville{}".format(digest[7]),
+        "context": postcode[:2],
+        "citycode": postcode,
+        "x": lon,
+        "y": lat,
+    }
+
+def feature(text, index=0):
+    properties = address("{}#{}".format(text, index))
+    lon, lat = properties.pop("x"), properties.pop("y")
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": properties}
+
+def csvResult(text):
+    properties = address(text + "#0")
+    result = {"latitude": properties["y"], "longitude": properties["x"]}
+    for name in ("label", "score", "type", "id", "housenumber", "name", "street", "postcode", "city", "context", "citycode"):
+        result["result_" + name] = properties[name]
+    return result
+
+def parseMultipart(contentType, body):
+    ''' return the form fields as (name, value) and the uploaded file content
+    '''
+    message = BytesParser(policy=policy.HTTP).parsebytes(b"Content-Type: " + contentType.encode('latin-1') + b"\r\n\r\n" + body)
+    fields, data = [], b""
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if part.get_filename() is not None:
+            data = part.get_payload(decode=True)
+        else:
+            fields.append((name, part.get_payload(decode=True).decode('utf-8')))
+    return fields, data
+
+class MockBanHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def delay(self):
+        ''' wait for the configured latency and return True when the request should fail
+        '''
+        server = self.server
+        time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+        return random.random() < server.errorRate
+
+    def send(self, status, content, contentType):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(content)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def sendError(self):
+        self.send(self.server.errorStatus, b'{"code": 503, "message": "mock error"}', "application/json")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path.rstrip('/').endswith('/search'):
+            text = params.get("q", "")
+            limit = min(int(params.get("limit", 5)), self.server.features)
+        elif url.path.rstrip('/').endswith('/reverse'):
+            text = "{},{}".format(params.get("lon"), params.get("lat"))
+            limit = min(int(params.get("limit", 1)), self.server.features)
+        else:
+            self.send(404, b"", "text/plain")
+            return
+        if self.delay():
+            self.sendError()
+            return
+        collection = {"type": "FeatureCollection", "features": [feature(text, i) for i in range(limit)]}
+        self.send(200, json.dumps(collection).encode('utf-8'), "application/json")
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip('/')
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not path.endswith('/csv'):
+            self.send(404, b"", "text/plain")
+            return
+        if self.delay():
+            self.sendError()
+            return
+        fields, data = parseMultipart(self.headers.get("Content-Type", ""), body)
+        columns = [value for name, value in fields if name == "columns"]
+        resultColumns = [value for name, value in fields if name == "result_columns"] or SEARCH_COLUMNS
+        reader = csv.DictReader(io.StringIO(data.decode('utf-8-sig')))
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(reader.fieldnames + resultColumns)
+        rows = list(reader)
+        if self.server.shuffle:
+            random.shuffle(rows)
+        for row in rows:
+            result = csvResult(' '.join(row[column] for column in (columns or reader.fieldnames)))
+            writer.writerow([row[name] for name in reader.fieldnames] + [result.get(column, "") for column in resultColumns])
+        self.send(200, output.getvalue().encode('utf-8'), "text/csv; charset=utf-8")
+
+class MockBanServer(ThreadingHTTPServer):
+    ''' mock BAN API listening on localhost, port 0 picks a free port.
+        latency and jitter are in seconds, features is the maximum number of features per answer.
+        With shuffle, the rows of the csv answers are sent in random order
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.02, jitter=0.005, errorRate=0.0, errorStatus=503, features=5, shuffle=False):
+        super().__init__(("127.0.0.1", port), MockBanHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+        self.features = features
+        self.shuffle = shuffle
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock of the BAN API")
+    parser.add_argument("--port", type=int, default=7878)
+    parser.add_argument("--latency", type=float, default=20, help="mean latency in ms")
+    parser.add_argument("--jitter", type=float, default=5, help="standard deviation of the latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of the requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--features", type=int, default=5, help="maximum number of features per answer")
+    parser.add_argument("--shuffle", action="store_true", help="answer the csv rows in random order")
+    args = parser.parse_args()
+    server = MockBanServer(args.port, args.latency / 1000, args.jitter / 1000, args.error_rate, args.error_status, args.features,
+                           args.shuffle)
+    print("Mock BAN API on " + server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
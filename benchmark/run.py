@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' benchmark of the geocoding paths of the plugin against the mock BAN API.
+    Run it with the python interpreter of QGIS from the plugin directory:
+
+        python benchmark/run.py --latency 20 --error-rate 0.01 --json results.json
+
+    --startup runs the plugin start in fresh interpreters and measures the time QGIS spends loading it
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARK)
+sys.path.insert(0, BENCHMARK)
+
+from qgis.PyQt.QtCore import QCoreApplication, QEventLoop
+from qgis.core import QgsApplication
+
+from mockban import MockBanServer
+
+STREETS = ["rue de la Paix", "avenue Jean Jaurès", "boulevard Victor Hugo", "place de la République", "chemin des Vignes",
+           "rue du Moulin", "allée des Tilleuls", "impasse des Lilas", "route de Lyon", "quai Saint-Michel"]
+CITIES = [("63000", "Clermont-Ferrand"), ("75011", "Paris"), ("69003", "Lyon"), ("13001", "Marseille"), ("33000", "Bordeaux"),
+          ("44000", "Nantes"), ("67000", "Strasbourg"), ("31000", "Toulouse"), ("59000", "Lille"), ("35000", "Rennes")]
+
+def loadPlugin():
+    ''' import the plugin as the gban package whatever the name of its directory. It is imported through
+        a gban link when possible, so that the offline worker processes can import it too
+    '''
+    directory = os.path.dirname(ROOT)
+    if os.path.basename(ROOT) != "gban":
+        directory = tempfile.mkdtemp()
+        try:
+            os.symlink(ROOT, os.path.join(directory, "gban"))
+        except OSError:
+            directory = None
+    if directory is not None:
+        sys.path.insert(0, directory)
+        import gban
+        return gban
+    spec = importlib.util.spec_from_file_location("gban", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["gban"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def queries(count, seed=0):
+    generator = random.Random(seed)
+    return ["{} {} {} {}".format(generator.randint(1, 200), generator.choice(STREETS), *generator.choice(CITIES)) for _ in range(count)]
+
+def points(count, seed=0):
+    generator = random.Random(seed)
+    return [(generator.uniform(-4.5, 8.0), generator.uniform(42.5, 51.0)) for _ in range(count)]
+
+def percentile(latencies, fraction):
+    latencies = sorted(latencies)
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+def result(name, count, elapsed, latencies, errors=0):
+    return {"scenario": name, "count": count, "errors": errors, "seconds": elapsed, "qps": count / elapsed if elapsed else None,
+            "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95), "p99": percentile(latencies, 0.99)}
+
+def runAsync(name, call, items):
+    ''' submit every item at once and wait for all the callbacks, latencies include the time spent queued
+    '''
+    loop = QEventLoop()
+    latencies = []
+    errors = []
+    def done(started, response):
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.error is not None:
+            errors.append(response.error)
+        if len(latencies) == len(items):
+            loop.quit()
+    started = time.perf_counter()
+    for item in items:
+        call(item, lambda response, submitted=time.perf_counter(): done(submitted, response))
+    if len(latencies) < len(items):
+        loop.exec_()
+    return result(name, len(items), time.perf_counter() - started, latencies, len(errors))
+
+def runBatch(name, geocoder, rows):
+    ''' geocode rows in chunks, latencies are those of the chunk requests
+    '''
+    from gban.batch import BatchError
+    from gban.stats import stats
+    stats.clear()
+    started = time.perf_counter()
+    count = 0
+    try:
+        for _ in geocoder.geocode(rows):
+            count += 1
+    except BatchError as e:
+        print("{}: {}".format(name, e), file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    latencies = [sample[2] for sample in stats.samples]
+    return dict(result(name, count, elapsed, latencies, stats.errors), requests=len(latencies))
+
+def benchmark(url, args):
+    from gban.backends import AddokBackend, CachedBackend, OfflineBackend
+    from gban.batch import BatchGeocoder, BatchReverseGeocoder
+    from gban.cache import GeocodeCache
+    from gban.executor import processCount
+    from gban.network import RequestQueue
+
+    results = []
+    sequential = AddokBackend(url, RequestQueue(1))
+    backend = AddokBackend(url, RequestQueue(args.concurrent))
+    search = lambda query, callback: backend.search(query, callback, limit=5)
+    reverse = lambda point, callback: backend.reverse(point[0], point[1], callback)
+    results.append(runAsync("search, 1 connection", lambda query, callback: sequential.search(query, callback, limit=5),
+                            queries(args.count, 1)))
+    results.append(runAsync("search, {} connections".format(args.concurrent), search, queries(args.count, 2)))
+    results.append(runAsync("reverse, {} connections".format(args.concurrent), reverse, points(args.count, 3)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = GeocodeCache(os.path.join(directory, "cache.sqlite"))
+        cached = CachedBackend(backend, cache)
+        items = queries(args.count, 4)
+        results.append(runAsync("search, cache cold", lambda query, callback: cached.search(query, callback, limit=5), items))
+        results.append(runAsync("search, cache warm", lambda query, callback: cached.search(query, callback, limit=5), items))
+        cache.close()
+
+    rows = [(i, [query]) for i, query in enumerate(queries(args.rows, 5))]
+    results.append(runBatch("batch search", BatchGeocoder(["q"], args.chunk_size, url + "/search/csv/"), rows))
+    rows = [(i, ["{:.6f}".format(lon), "{:.6f}".format(lat)]) for i, (lon, lat) in enumerate(points(args.rows, 6))]
+    results.append(runBatch("batch reverse", BatchReverseGeocoder(args.chunk_size, 0, url + "/reverse/csv/"), rows))
+
+    if args.offline:
+        offline = OfflineBackend(args.offline)
+        results.append(runAsync("offline search", lambda query, callback: offline.search(query, callback), queries(args.count, 7)))
+        results.append(runAsync("offline reverse", lambda point, callback: offline.reverse(point[0], point[1], callback), points(args.count, 8)))
+        rows = [(i, [query]) for i, query in enumerate(queries(args.rows, 9))]
+        for processes in sorted({1, processCount(args.processes)}):
+            geocoder = OfflineBackend(args.offline, processes).batchGeocoder(["q"], args.chunk_size)
+            results.append(runBatch("offline batch, {} process{}".format(processes, "es" if processes > 1 else ""), geocoder, rows))
+    return results
+
+def startupChild():
+    ''' load the plugin like QGIS does with a mocked interface, print the timings in ms as JSON
+    '''
+    from qgis.PyQt.QtWidgets import QToolBar
+    from qgis.testing.mocked import get_iface
+    app = QgsApplication([], True)
+    app.initQgis()
+    QCoreApplication.setOrganizationName("gban-benchmark")
+    iface = get_iface()
+    iface.addToolBar.side_effect = lambda name: QToolBar(name, iface.mainWindow())
+    modules = set(sys.modules)
+    started = time.perf_counter()
+    module = loadPlugin()
+    imported = time.perf_counter()
+    plugin = module.classFactory(iface)
+    created = time.perf_counter()
+    plugin.initGui()
+    ready = time.perf_counter()
+    print(json.dumps({"import": (imported - started) * 1000, "classFactory": (created - imported) * 1000,
+                      "initGui": (ready - created) * 1000, "total": (ready - started) * 1000,
+                      "modules": sorted(name for name in set(sys.modules) - modules if name.startswith("gban"))}))
+    plugin.unload()
+    app.exitQgis()
+
+def startup(runs):
+    ''' median timings of the plugin start over runs fresh interpreters, so that every import is cold
+    '''
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-child"], check=True,
+                                stdout=subprocess.PIPE, env=dict(os.environ, QT_QPA_PLATFORM="offscreen")).stdout
+        samples.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+    timings = {step: statistics.median(sample[step] for sample in samples) for step in ("import", "classFactory", "initGui", "total")}
+    return dict(timings, runs=runs, modules=samples[-1]["modules"])
+
+def printStartup(timings):
+    print("startup over {runs} runs: {total:.1f} ms (import {import:.1f} ms, classFactory {classFactory:.1f} ms, "
+          "initGui {initGui:.1f} ms), {count} plugin modules loaded".format(count=len(timings["modules"]), **timings))
+
+def printResults(results):
+    print("{:<26} {:>7} {:>7} {:>10} {:>9} {:>9} {:>9}".format("scenario", "count", "errors", "qps", "p50 ms", "p95 ms", "p99 ms"))
+    for r in results:
+        print("{:<26} {:>7} {:>7} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            r["scenario"], r["count"], r["errors"], r["qps"] or 0, r["p50"] or 0, r["p95"] or 0, r["p99"] or 0))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the Gban geocoding paths against a mock BAN API")
+    parser.add_argument("--latency", type=float, default=20, help="mean latency of the mock API in ms")
+    parser.add_argument("--jitter", type=float, default=5, help="standard deviation of the latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of the requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--features", type=int, default=5, help="maximum number of features per answer")
+    parser.add_argument("--count", type=int, default=500, help="number of interactive lookups per scenario")
+    parser.add_argument("--rows", type=int, default=20000, help="number of rows of the batch scenarios")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--concurrent", type=int, default=4, help="maximum concurrent interactive requests")
+    parser.add_argument("--rate", type=float, default=0, help="request rate limit, 0 for unlimited")
+    parser.add_argument("--offline", help="offline index to benchmark too")
+    parser.add_argument("--processes", type=int, default=0, help="worker processes of the offline batch, 0 for one per core")
+    parser.add_argument("--startup", type=int, default=0, help="number of plugin starts to measure, 0 to skip")
+    parser.add_argument("--startup-only", action="store_true", help="only measure the plugin start")
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    if args.startup_child:
+        startupChild()
+        return
+    timings = startup(args.startup) if args.startup else None
+    if timings is not None:
+        printStartup(timings)
+    if args.startup_only:
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({"parameters": vars(args), "startup": timings}, f, indent=1)
+        return
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    # Keep the settings of the user profile out of the measures
+    QCoreApplication.setOrganizationName("gban-benchmark")
+
+    loadPlugin()
+    from gban.network import limiter
+    limiter.setRate(args.rate)
+
+    server = MockBanServer(0, args.latency / 1000, args.jitter / 1000, args.error_rate, args.error_status, args.features).start()
+    try:
+        results = benchmark(server.url, args)
+    finally:
+        server.stop()
+    printResults(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"parameters": vars(args), "startup": timings, "results": results}, f, indent=1)
+    app.exitQgis()
+
+if __name__ == "__main__":
+    main()
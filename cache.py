@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import time
+import unicodedata
+
+def normalize(text):
+    ''' lower case, strip accents and collapse whitespaces
+    '''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.lower().split())
+
+def searchKey(query, **params):
+    key = 'search:' + normalize(query)
+    for name in sorted(params):
+        key += '&{}={}'.format(name, params[name])
+    return key
+
+def reverseKey(lon, lat, precision=5):
+    ''' round the coordinates so that nearby clicks share the same entry (5 decimals is about 1 m)
+    '''
+    return 'reverse:{:.{p}f},{:.{p}f}'.format(lon, lat, p=precision)
+
+class GeocodeCache:
+    ''' persistent cache of responses, entries expire after ttl seconds
+        and the least recently used ones are evicted above maxEntries
+    '''
+
+    def __init__(self, path, ttl=30 * 86400, maxEntries=100000):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        # Access times are kept in memory and written with the next insertion,
+        # so that a hit does not cost a disk write
+        self.touched = {}
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, content BLOB, created REAL, accessed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self.count = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key):
+        row = self.connection.execute("SELECT content, created FROM cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched[key] = now
+        return row[0]
+
+    def put(self, key, content):
+        now = time.time()
+        with self.connection:
+            self.flush()
+            if self.connection.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is None:
+                self.count += 1
+            self.connection.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, content, now, now))
+            if self.count > self.maxEntries:
+                self.evict()
+
+    def evict(self):
+        # Drop expired entries first, then the least recently used ones down to 90% of
+        # the cap, so that the eviction does not run again on the next insertions
+        self.connection.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+        count = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        target = self.maxEntries * 9 // 10
+        if count > target:
+            self.connection.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)", (count - target,))
+        self.count = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def flush(self):
+        if self.touched:
+            self.connection.executemany("UPDATE cache SET accessed = ? WHERE key = ?", [(accessed, key) for key, accessed in self.touched.items()])
+            self.touched.clear()
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM cache")
+        self.touched.clear()
+        self.count = 0
+
+    def close(self):
+        with self.connection:
+            self.flush()
+        self.connection.close()
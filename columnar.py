@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Compact read only store of BAN addresses for national datasets. Like offline.py it does not
+# depend on QGIS. The file is memory mapped and its columns are used in place, so opening it
+# only reads its directory and a lookup only reads the pages it touches
+
+from array import array
+from bisect import bisect_left, bisect_right
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from .offline import CANDIDATES, FILTERS, feature, nearestFeatures, readBanCsv, similarity, tokenize
+
+# The columns are NumPy views when NumPy is installed, memoryviews otherwise
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SUFFIX = '.gban'
+MAGIC = b'GBANCOL1'
+
+# Coordinates are stored as integers in 1e-7 degrees (about 1 cm)
+SCALE = 10 ** 7
+# Size of the cells of the spatial index in 1e-7 degrees (about 100 m)
+CELL = 10000
+LON_CELLS = 360 * SCALE // CELL
+
+# Most streets checked for the tokens of a query
+MAX_STREETS = 20000
+
+# Most words of a commune name
+MAX_NAME_WORDS = 8
+
+# Words following the number of an address in a query
+REPETITIONS = ('bis', 'ter', 'quater', 'quinquies', 'a', 'b', 'c', 'd')
+
+# Columns of the store, one value per address. The addresses are sorted by key (street << 32 | commune)
+# then number, the spatial index holds the sorted cells of the addresses and their row in the same order.
+#   keys: Q, numbers: I (housenumber id), lons: i, lats: i, cells: Q, spatial: I
+# String tables (name.blob and name.offsets): banIds (one per address), streets, postcodes, citycodes, cities
+# (one per commune), housenumbers. Key indexes (nameKeys table, namePostings.offsets and namePostings)
+# give the sorted ids of the streets holding a token and of the communes having a postcode or a name
+# (its tokens joined by spaces). pairs (Q) holds the sorted distinct commune << 32 | street
+
+def searchsorted(values, value, side='left'):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return int(numpy.searchsorted(values, values.dtype.type(value), side))
+    return (bisect_left if side == 'left' else bisect_right)(values, value)
+
+def contains(values, value):
+    ''' whether a sorted column holds value
+    '''
+    index = searchsorted(values, value)
+    return index < len(values) and values[index] == value
+
+def intersect(postings):
+    ''' ids present in every sorted posting list
+    '''
+    postings = sorted(postings, key=len)
+    if numpy is not None:
+        common = postings[0]
+        for other in postings[1:]:
+            common = numpy.intersect1d(common, other, assume_unique=True)
+        return [int(value) for value in common]
+    common = set(postings[0])
+    for other in postings[1:]:
+        common.intersection_update(other)
+    return sorted(common)
+
+def cell(lon, lat):
+    ''' spatial index key of a point given in 1e-7 degrees
+    '''
+    return (lat + 90 * SCALE) // CELL * LON_CELLS + (lon + 180 * SCALE) // CELL
+
+class StringTable:
+    ''' sequence of strings stored in one utf-8 blob, decoded on access
+    '''
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return str(self.blob[int(self.offsets[index]):int(self.offsets[index + 1])], 'utf-8')
+
+class ColumnarIndex:
+    ''' read only store of BAN addresses built by buildColumnar, answering like OfflineIndex.
+        It can be shared between threads
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < 24 or self.map[:8] != MAGIC or self.map[-8:] != MAGIC:
+            self.map.close()
+            raise ValueError("Not a Gban address store: " + path)
+        start = struct.unpack('<Q', self.map[-16:-8])[0]
+        directory = json.loads(self.map[start:-16].decode('utf-8'))
+        if directory["byteorder"] != sys.byteorder:
+            self.map.close()
+            raise ValueError("Address store built on a machine of another byte order: " + path)
+        self.sections = directory["sections"]
+        self.size = directory["count"]
+        self.columns = {name: self.column(name) for name in ("keys", "numbers", "lons", "lats", "cells", "spatial", "pairs",
+                                                             "streetPostings", "communePostings")}
+        self.tables = {name: StringTable(self.column(name + ".offsets"), self.column(name + ".blob"))
+                       for name in ("banIds", "streets", "postcodes", "citycodes", "cities", "housenumbers", "streetKeys",
+                                    "communeKeys")}
+        self.postingOffsets = {name: self.column(name + "Postings.offsets") for name in ("street", "commune")}
+        self.citycodes = None
+        self.numberIds = None
+
+    def column(self, name):
+        offset, typecode, count = self.sections[name]
+        if numpy is not None:
+            return numpy.frombuffer(self.map, numpy.dtype(typecode), count, offset)
+        return memoryview(self.map)[offset:offset + count * array(typecode).itemsize].cast(typecode)
+
+    def count(self):
+        return self.size
+
+    def postings(self, name, key):
+        ''' sorted ids of the streets holding a token or of the communes having a postcode or name (key)
+        '''
+        keys = self.tables[name + "Keys"]
+        index = bisect_left(keys, key)
+        if index == len(keys) or keys[index] != key:
+            return []
+        offsets = self.postingOffsets[name]
+        return self.columns[name + "Postings"][int(offsets[index]):int(offsets[index + 1])]
+
+    def row(self, index):
+        ''' address row shaped like those of OfflineIndex
+        '''
+        key = int(self.columns["keys"][index])
+        street, commune = key >> 32, key & 0xffffffff
+        housenumber = self.tables["housenumbers"][int(self.columns["numbers"][index])]
+        name = self.tables["streets"][street]
+        postcode, city = self.tables["postcodes"][commune], self.tables["cities"][commune]
+        label = ' '.join(filter(None, [housenumber, name, postcode, city]))
+        return (self.tables["banIds"][index], label, housenumber, name, postcode, self.tables["citycodes"][commune], city,
+                int(self.columns["lons"][index]) / SCALE, int(self.columns["lats"][index]) / SCALE)
+
+    def search(self, query, limit=5, **filters):
+        ''' return a GeoJSON FeatureCollection shaped like the /search/ answer of the BAN API,
+            filters can be postcode or citycode
+        '''
+        tokens = tokenize(query)
+        rows = self.candidates(tokens, self.filteredCommunes(filters)) if tokens else []
+        # Ties are ordered by row so that every process and every run ranks them the same
+        scored = sorted(((similarity(tokens, row[1]), row) for row in dict.fromkeys(rows)), key=lambda item: (-item[0], item[1]))
+        return {
+            "type": "FeatureCollection",
+            "query": query,
+            "features": [feature(row, score) for score, row in scored[:limit]],
+        }
+
+    def candidates(self, tokens, allowed):
+        number = []
+        if tokens[0].isdigit():
+            number = tokens[:2] if len(tokens) > 1 and tokens[1] in REPETITIONS else tokens[:1]
+        words = tokens[len(number):]
+        communes, communeWords = self.matchCommunes(words, allowed)
+        postings = [self.postings("street", word) for word in words if word not in communeWords]
+        if not postings:
+            return []
+        # The words naming the commune may also be part of the street name (rue de Paris, Paris)
+        others = [self.postings("street", word) for word in communeWords]
+        pairs = self.pairs(postings, communes, others)
+        if not pairs and len(postings) > 1:
+            # Allow one word to be missing (typo, unknown word)
+            for i in range(len(postings)):
+                pairs += self.pairs(postings[:i] + postings[i + 1:], communes, others)
+        rows = []
+        for street, commune in pairs[:CANDIDATES]:
+            rows += self.addresses(street, commune, ' '.join(number))
+        return rows
+
+    def filteredCommunes(self, filters):
+        ''' ids of the communes allowed by the filters, None when every commune is
+        '''
+        communes = None
+        for name in sorted(filters):
+            if name not in FILTERS:
+                raise ValueError("Unknown filter: " + name)
+            if name == 'postcode':
+                matching = {int(commune) for commune in self.postings("commune", filters[name])}
+            else:
+                matching = self.communesByCitycode().get(filters[name], set())
+            communes = matching if communes is None else communes & matching
+        return communes
+
+    def communesByCitycode(self):
+        # Built once complete and then published, the threads sharing the index never see it half filled
+        if self.citycodes is None:
+            citycodes = self.tables["citycodes"]
+            communes = {}
+            for commune in range(len(citycodes)):
+                communes.setdefault(citycodes[commune], set()).add(commune)
+            self.citycodes = communes
+        return self.citycodes
+
+    def numbersByToken(self):
+        if self.numberIds is None:
+            housenumbers = self.tables["housenumbers"]
+            numberIds = {}
+            for numberId in range(len(housenumbers)):
+                numberIds.setdefault(' '.join(tokenize(housenumbers[numberId])), set()).add(numberId)
+            self.numberIds = numberIds
+        return self.numberIds
+
+    def matchCommunes(self, words, allowed):
+        ''' communes named in the query by their postcode or their name, those named by most words first,
+            and the words naming them
+        '''
+        named = {}
+        for start in range(len(words)):
+            for end in range(start + 1, min(len(words), start + MAX_NAME_WORDS) + 1):
+                for commune in self.postings("commune", ' '.join(words[start:end])):
+                    commune = int(commune)
+                    if allowed is None or commune in allowed:
+                        named.setdefault(commune, set()).update(words[start:end])
+        if not named:
+            return allowed, set()
+        best = max(len(found) for found in named.values())
+        communes = [commune for commune, found in named.items() if len(found) == best]
+        return communes, set().union(*(named[commune] for commune in communes))
+
+    def pairs(self, postings, communes, others=()):
+        ''' (street, commune) holding every token of postings, commune is None when the query names none.
+            The streets of named communes also holding the tokens of others come first
+        '''
+        if communes is None:
+            return [(street, None) for street in intersect(postings)[:MAX_STREETS]]
+        postings = sorted(postings, key=len)
+        pairs = []
+        keys = self.columns["pairs"]
+        for commune in communes:
+            first, last = searchsorted(keys, commune << 32), searchsorted(keys, (commune + 1) << 32)
+            for key in keys[first:min(last, first + MAX_STREETS)]:
+                street = int(key) & 0xffffffff
+                if all(contains(other, street) for other in postings):
+                    pairs.append((-sum(contains(other, street) for other in others), street, commune))
+        return [(street, commune) for rank, street, commune in sorted(pairs)]
+
+    def addresses(self, street, commune, number):
+        ''' rows of the address at number of a street in a commune, or of its first address when number is not found.
+            Every commune having the street is searched when commune is None
+        '''
+        keys = self.columns["keys"]
+        if commune is None:
+            first, last = searchsorted(keys, street << 32), searchsorted(keys, (street + 1) << 32)
+        else:
+            first, last = searchsorted(keys, street << 32 | commune), searchsorted(keys, street << 32 | commune, 'right')
+        rows = []
+        while first < last and len(rows) < CANDIDATES:
+            end = searchsorted(keys, int(keys[first]), 'right')
+            rows += self.numbered(first, end, number) or [self.row(first)]
+            first = end
+        return rows
+
+    def numbered(self, first, last, number):
+        if not number:
+            return []
+        numberIds = self.numbersByToken().get(number, set())
+        numbers = self.columns["numbers"]
+        return [self.row(index) for index in range(first, last) if int(numbers[index]) in numberIds]
+
+    def reverse(self, lon, lat, limit=1):
+        ''' return the nearest addresses as a GeoJSON FeatureCollection shaped like the /reverse/ answer of the BAN API
+        '''
+        return nearestFeatures(lon, lat, limit, self.addressesIn, self.row)
+
+    def addressesIn(self, minLon, maxLon, minLat, maxLat):
+        cells, spatial = self.columns["cells"], self.columns["spatial"]
+        lons, lats = self.columns["lons"], self.columns["lats"]
+        first, last = cell(round(minLon * SCALE), round(minLat * SCALE)), cell(round(maxLon * SCALE), round(minLat * SCALE))
+        addresses = []
+        # The cells of a row of the grid are contiguous in the index
+        for row in range(cell(0, round(maxLat * SCALE)) // LON_CELLS - cell(0, round(minLat * SCALE)) // LON_CELLS + 1):
+            start = searchsorted(cells, first + row * LON_CELLS)
+            end = searchsorted(cells, last + row * LON_CELLS, 'right')
+            for index in spatial[start:end]:
+                index = int(index)
+                addresses.append((int(lons[index]) / SCALE, int(lats[index]) / SCALE, index))
+        return addresses
+
+    def close(self):
+        # The views should be released before the map is closed
+        self.columns.clear()
+        self.tables.clear()
+        self.postingOffsets.clear()
+        self.map.close()
+
+class Writer:
+    ''' write the sections of a store, their directory is written at the end of the file
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.sections = {}
+
+    def align(self):
+        self.file.write(b'\0' * (-self.file.tell() % 8))
+        return self.file.tell()
+
+    def write(self, name, values, typecode):
+        ''' values is an array or a NumPy array of typecode
+        '''
+        offset = self.align()
+        values.tofile(self.file)
+        self.sections[name] = [offset, typecode, len(values)]
+
+    def strings(self, name, strings):
+        offsets = array('Q', [0])
+        offset = self.align()
+        for string in strings:
+            data = string if isinstance(string, bytes) else string.encode('utf-8')
+            self.file.write(data)
+            offsets.append(offsets[-1] + len(data))
+        self.sections[name + ".blob"] = [offset, 'B', offsets[-1]]
+        self.write(name + ".offsets", offsets, 'Q')
+
+    def keys(self, name, keys):
+        ''' key index: the sorted keys and the sorted ids holding each one, keys gives the keys of every id
+        '''
+        index = {}
+        for keyId, idKeys in enumerate(keys):
+            for key in idKeys:
+                index.setdefault(key, array('I')).append(keyId)
+        sortedKeys = sorted(index)
+        offsets = array('Q', [0])
+        postings = array('I')
+        for key in sortedKeys:
+            postings.extend(index[key])
+            offsets.append(len(postings))
+        self.strings(name + "Keys", sortedKeys)
+        self.write(name + "Postings", postings, 'I')
+        self.write(name + "Postings.offsets", offsets, 'Q')
+
+    def close(self, count):
+        offset = self.align()
+        self.file.write(json.dumps({"byteorder": sys.byteorder, "count": count, "sections": self.sections}).encode('utf-8'))
+        self.file.write(struct.pack('<Q', offset) + MAGIC)
+        self.file.close()
+
+def sortedOrder(keys, numbers):
+    ''' order of the addresses sorted by key then number
+    '''
+    if numpy is not None:
+        return numpy.lexsort((numpy.frombuffer(numbers, numpy.uint32), numpy.frombuffer(keys, numpy.uint64)))
+    return sorted(range(len(keys)), key=lambda index: (keys[index], numbers[index]))
+
+def take(values, order, typecode):
+    if numpy is not None:
+        return numpy.frombuffer(values, numpy.dtype(typecode))[order]
+    return array(typecode, (values[index] for index in order))
+
+def buildColumnar(paths, path, progress=lambda fraction: None, isCanceled=lambda: False):
+    ''' build a store at path from BAN address csv exports (adresses-XX.csv[.gz]) and return its number of addresses.
+        The store is rebuilt from all the given files, each of them should be given once
+    '''
+    streets, communes, housenumbers = {}, {}, {}
+    streetIds, communeIds, numberIds, sortNumbers = array('I'), array('I'), array('I'), array('I')
+    lons, lats = array('i'), array('i')
+    idOffsets = array('Q', [0])
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path))) as banIds:
+        for fileIndex, csvPath in enumerate(paths):
+            size = max(os.path.getsize(csvPath), 1)
+            for count, (raw, row) in enumerate(readBanCsv(csvPath), 1):
+                housenumber = ' '.join(filter(None, [row['numero'], row['rep']]))
+                streetIds.append(streets.setdefault(row['nom_voie'], len(streets)))
+                communeIds.append(communes.setdefault((row['code_postal'], row['code_insee'], row['nom_commune']), len(communes)))
+                numberIds.append(housenumbers.setdefault(housenumber, len(housenumbers)))
+                sortNumbers.append(int(row['numero']) if row['numero'].isdigit() else 0)
+                lons.append(round(float(row['lon']) * SCALE))
+                lats.append(round(float(row['lat']) * SCALE))
+                banId = row['id'].encode('utf-8')
+                banIds.write(banId)
+                idOffsets.append(idOffsets[-1] + len(banId))
+                if count % 10000 == 0:
+                    if isCanceled():
+                        raise InterruptedError()
+                    progress(0.8 * (fileIndex + raw.tell() / size) / len(paths))
+
+        if numpy is not None:
+            keys = numpy.frombuffer(streetIds, numpy.uint32).astype(numpy.uint64) << numpy.uint64(32) | numpy.frombuffer(communeIds, numpy.uint32)
+        else:
+            keys = array('Q', (street << 32 | commune for street, commune in zip(streetIds, communeIds)))
+        order = sortedOrder(keys, sortNumbers)
+        lons, lats = take(lons, order, 'i'), take(lats, order, 'i')
+        if numpy is not None:
+            cells = cell(lons.astype(numpy.int64), lats.astype(numpy.int64)).astype(numpy.uint64)
+            spatial = numpy.argsort(cells, kind='stable').astype(numpy.uint32)
+        else:
+            cells = array('Q', (cell(lon, lat) for lon, lat in zip(lons, lats)))
+            spatial = array('I', sorted(range(len(cells)), key=cells.__getitem__))
+        if isCanceled():
+            raise InterruptedError()
+        progress(0.9)
+
+        temporary = path + ".tmp"
+        writer = Writer(temporary)
+        try:
+            writer.write("keys", take(keys, order, 'Q'), 'Q')
+            writer.write("numbers", take(numberIds, order, 'I'), 'I')
+            writer.write("lons", lons, 'i')
+            writer.write("lats", lats, 'i')
+            writer.write("cells", take(cells, spatial, 'Q'), 'Q')
+            writer.write("spatial", spatial, 'I')
+            banIds.flush()
+            if len(lons):
+                with mmap.mmap(banIds.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+                    writer.strings("banIds", (blob[idOffsets[index]:idOffsets[index + 1]] for index in order))
+            else:
+                writer.strings("banIds", [])
+            writer.strings("streets", streets)
+            writer.strings("postcodes", (commune[0] for commune in communes))
+            writer.strings("citycodes", (commune[1] for commune in communes))
+            writer.strings("cities", (commune[2] for commune in communes))
+            writer.strings("housenumbers", housenumbers)
+            writer.keys("street", (set(tokenize(street)) for street in streets))
+            writer.keys("commune", ({postcode, ' '.join(tokenize(city))} for postcode, citycode, city in communes))
+            writer.write("pairs", array('Q', sorted({commune << 32 | street for street, commune in zip(streetIds, communeIds)})), 'Q')
+            writer.close(len(lons))
+        except BaseException:
+            writer.file.close()
+            os.remove(temporary)
+            raise
+    os.replace(temporary, path)
+    progress(1.0)
+    return len(lons)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Names of the result columns and filters, without dependencies so that the processing algorithms can be registered
+# without importing the geocoders
+
+RESULT_COLUMNS = ["longitude", "latitude", "result_label", "result_score", "result_citycode"]
+REVERSE_RESULT_COLUMNS = ["result_label", "result_score", "result_housenumber", "result_street",
+                          "result_postcode", "result_city", "result_citycode"]
+
+# Types of result the second pass can be restricted to
+RESULT_TYPES = ["", "housenumber", "street", "locality", "municipality"]
+
+def filterColumns(postcode, citycode):
+    ''' {filter: column} of the second pass for the chosen fields
+    '''
+    return {name: column for name, column in (('postcode', postcode), ('citycode', citycode)) if column}
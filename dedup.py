@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import math
+
+from .cache import normalize
+
+def searchKey(values):
+    return normalize(' '.join(values))
+
+class ReverseKey:
+    ''' snap [lon, lat] values on a grid of tolerance meters, points of the same cell share their key
+    '''
+
+    def __init__(self, tolerance):
+        self.latStep = tolerance / 111320.0
+
+    def __call__(self, values):
+        lon, lat = float(values[0]), float(values[1])
+        if self.latStep <= 0:
+            return (lon, lat)
+        lonStep = self.latStep / max(math.cos(math.radians(lat)), 0.01)
+        return (round(lon / lonStep), round(lat / self.latStep))
+
+class Coalescer:
+    ''' send only one request for the rows sharing the same key, results are remembered
+        (up to maxResults, least recently used first out) for the next chunks
+    '''
+
+    def __init__(self, key, maxResults=100000):
+        self.key = key
+        self.maxResults = maxResults
+        self.results = OrderedDict()
+        self.rows = 0
+        self.requests = 0
+
+    def chunks(self, rows, size):
+        ''' yield (chunk, requests), chunk being the (id, key) of the rows and requests
+            the {key: values} to send, at most size of them
+        '''
+        chunk, requests = [], {}
+        for rowId, values in rows:
+            key = self.key(values)
+            chunk.append((rowId, key))
+            if key not in self.results and key not in requests:
+                requests[key] = values
+            # Chunks of duplicates are bounded too so that progress keeps being reported
+            if len(requests) == size or len(chunk) == size * 10:
+                yield chunk, requests
+                chunk, requests = [], {}
+        if chunk:
+            yield chunk, requests
+
+    def fanOut(self, chunk, answers):
+        ''' yield (id, result) for every row of the chunk from the new answers or the remembered results
+        '''
+        for rowId, key in chunk:
+            result = answers.get(key)
+            if result is None:
+                result = self.results[key]
+                self.results.move_to_end(key)
+            yield rowId, result
+        self.rows += len(chunk)
+        self.requests += len(answers)
+        self.results.update(answers)
+        while len(self.results) > self.maxResults:
+            self.results.popitem(last=False)
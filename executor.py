@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Worker processes only import this module and the indexes, none of them depends on QGIS
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import sys
+
+from .columnar import SUFFIX, ColumnarIndex
+from .offline import OfflineIndex
+
+# Rows of a chunk below which matching in worker processes does not pay for the round trips
+MIN_ROWS = 1000
+
+# Index opened by a worker process
+workerIndex = None
+
+def openIndex(path):
+    if path.endswith(SUFFIX):
+        return ColumnarIndex(path)
+    return OfflineIndex(path)
+
+def initWorker(path):
+    global workerIndex
+    workerIndex = openIndex(path)
+
+def search(rows, index=None):
+    ''' best feature, or None, of every (query, filters) row, in the index of the worker by default
+    '''
+    index = workerIndex if index is None else index
+    results = []
+    for query, filters in rows:
+        features = index.search(query, limit=1, **filters)["features"]
+        results.append(features[0] if features else None)
+    return results
+
+def reverse(rows, index=None):
+    ''' nearest feature, or None, of every (lon, lat) row
+    '''
+    index = workerIndex if index is None else index
+    results = []
+    for lon, lat in rows:
+        features = index.reverse(lon, lat)["features"]
+        results.append(features[0] if features else None)
+    return results
+
+def pythonExecutable():
+    ''' interpreter of the worker processes. Inside QGIS on Windows and macOS sys.executable is QGIS itself,
+        the interpreter shipped with it is searched in the Python prefix
+    '''
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    names = ['python.exe', 'pythonw.exe'] if sys.platform == 'win32' else ['python3', 'python']
+    for directory in (sys.exec_prefix, os.path.join(sys.exec_prefix, 'bin')):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return path
+    return sys.executable
+
+def processCount(processes):
+    ''' number of worker processes, processes is 0 for one per core
+    '''
+    count = processes if processes > 0 else os.cpu_count() or 1
+    # Windows can not wait for more than 61 processes
+    return min(count, 61) if sys.platform == 'win32' else count
+
+class ShardExecutor:
+    ''' match rows against the offline index in worker processes. The rows are split into shards,
+        one task each, and their results are merged in input order.
+        The pool is started on first use, every worker opens the read only index once
+    '''
+
+    def __init__(self, path, processes=0):
+        self.path = path
+        self.processes = processCount(processes)
+        self.pool = None
+
+    def map(self, function, rows):
+        if self.pool is None:
+            # Forking a QGIS process with its threads is not safe, workers are spawned
+            context = multiprocessing.get_context('spawn')
+            context.set_executable(pythonExecutable())
+            self.pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=context, initializer=initWorker,
+                                            initargs=(self.path,))
+        # A few shards per worker even out their load
+        size = max(1, -(-len(rows) // (self.processes * 4)))
+        shards = [rows[start:start + size] for start in range(0, len(rows), size)]
+        return [result for shard in self.pool.map(function, shards) for result in shard]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -17,20 +17,23 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from qgis.PyQt.QtCore import QSettings, QTranslator, qVersion, QCoreApplication, QUrl, QEventLoop
-from qgis.PyQt.QtGui import QColor, QIcon
-from qgis.PyQt.QtWidgets import QAction, QActionGroup, QApplication, QDialogButtonBox, QInputDialog, QMessageBox
+from qgis.PyQt.QtCore import QSettings, QTranslator, qVersion, QCoreApplication, Qt
+from qgis.PyQt.QtGui import QIcon
+from qgis.PyQt.QtWidgets import QAction, QActionGroup, QApplication, QDialogButtonBox, QFileDialog, QMessageBox
 
-from qgis.core import (QgsWkbTypes, QgsCoordinateReferenceSystem, QgsCoordinateTransform, 
-                        QgsNetworkContentFetcher, QgsPoint, QgsProject)
-from qgis.gui import QgsMapToolEmitPoint, QgsRubberBand
+from qgis.core import Qgis, QgsApplication, QgsCsException, QgsPoint, QgsProject, QgsVectorLayer
+from qgis.gui import QgsMapToolEmitPoint
 
-import json
-import unicodedata
-
-from . import resources
+# Only what the toolbar needs is imported at QGIS startup, the engines, caches, dialogs
+# and map tools are imported and created on first use
+from . import settings
+from .provider import GbanProvider
+from .searchwidget import MAX_BIAS_EXTENT, SearchWidget
+from .transforms import clearTransforms
 import os
 
+ICONS = os.path.join(os.path.dirname(__file__), 'resources')
+
 class Gban:
 
     def __init__(self, iface):
@@ -49,6 +52,10 @@ class Gban:
                 QCoreApplication.installTranslator(self.translator)
 
         self.iface = iface
+        self.provider = None
+        # qgis_process loads the plugin without interface, only for its Processing provider
+        if self.iface is None:
+            return
         self.canvas = self.iface.mapCanvas()
 
         self.exclusive = QActionGroup( self.iface.mainWindow() )
@@ -57,17 +64,37 @@ class Gban:
         self.menu = '&Gban'
         self.toolbar = self.iface.addToolBar('Gban')
         self.toolbar.setObjectName('Gban')
-        
-        #Select tool initialization
-        self.tool = QgsMapToolEmitPoint(self.canvas)
-        self.tool.canvasClicked.connect(self.doReverseGeocoding)
-        self.tool.deactivated.connect(self.uncheckReverseGeocoding)
-
-        self.rb = QgsRubberBand(self.iface.mapCanvas(), QgsWkbTypes.PointGeometry)
-        self.rb.setColor( QColor(255, 0, 0) )
-        self.rb.setWidth( 5 )
-                                   
+
+        self.tasks = []
+        # Edit watchers of the layers geocoded incrementally, by layer id
+        self.watchers = {}
+        # Built on first use
+        self.tool = None
+        self.overlayTool = None
+        self.statsDock = None
+        self.results = None
+        self.network = None
+        self.cache = None
+        self.backend = None
+        QgsProject.instance().transformContextChanged.connect(clearTransforms)
+
     def unload(self):
+        if self.provider is not None:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
+        if self.iface is None:
+            return
+        if self.network is not None:
+            self.network.abortAll()
+        if self.backend is not None:
+            self.backend.close()
+        if self.cache is not None:
+            self.cache.close()
+        QgsProject.instance().transformContextChanged.disconnect(clearTransforms)
+        for watcher in self.watchers.values():
+            watcher.stop()
+        if self.statsDock is not None:
+            self.iface.removeDockWidget(self.statsDock)
+            self.statsDock.deleteLater()
         for action in self.actions:
             self.iface.removePluginMenu('&Gban', action)
             self.iface.removeToolBarIcon(action)
@@ -116,92 +143,303 @@ class Gban:
 
         return action
 
+    def initProcessing(self):
+        self.provider = GbanProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
+    def requestQueue(self):
+        if self.network is None:
+            from .network import RequestQueue
+            self.network = RequestQueue(settings.value('network/maxConcurrent'))
+        return self.network
+
+    def geocodeCache(self):
+        if self.cache is None:
+            from .cache import GeocodeCache
+            self.cache = GeocodeCache(settings.profilePath('cache.sqlite'),
+                                      settings.value('cache/ttlDays') * 86400, settings.value('cache/maxEntries'))
+        return self.cache
+
+    def engine(self):
+        ''' backend chosen in the settings, built on the first request
+        '''
+        if self.backend is None:
+            from . import backends
+            self.backend = backends.fromSettings(self.requestQueue(), self.geocodeCache())
+        return self.backend
+
+    def dropBackend(self):
+        ''' release the files of the backend, the next request builds it again from the settings
+        '''
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+
     def initGui(self):
-        icon_path = ":/plugins/gban/resources/icon_geocode.png"
+        self.initProcessing()
+        self.searchBox = SearchWidget(self.engine, self.toolbar, self.searchLocation)
+        self.searchBox.resultSelected.connect(self.showResult)
+        self.searchBox.failed.connect(self.searchFailed)
+        self.toolbar.addWidget(self.searchBox)
+        icon_path = os.path.join(ICONS, "icon_geocode.png")
         self.add_action(
             icon_path,
             text=self.tr("Geocoding"),
             callback=self.geocoding,
             parent=self.iface.mainWindow()
         )
-        icon_path = ":/plugins/gban/resources/icon_reversegeocode.png"
-        self.add_action(
+        icon_path = os.path.join(ICONS, "icon_reversegeocode.png")
+        self.reverseAction = self.add_action(
             icon_path,
             checkable = True,
             text=self.tr("Reverse geocoding"),
             callback=self.reverseGeocoding,
             parent=self.iface.mainWindow()
         )
+        self.overlayAction = self.add_action(
+            icon_path,
+            checkable = True,
+            text=self.tr("Address overlay"),
+            callback=self.addressOverlay,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow()
+        )
+        icon_path = os.path.join(ICONS, "icon_geocode.png")
+        self.add_action(
+            icon_path,
+            text=self.tr("Batch geocoding"),
+            callback=self.batchGeocoding,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow()
+        )
+        icon_path = os.path.join(ICONS, "icon_reversegeocode.png")
+        self.add_action(
+            icon_path,
+            text=self.tr("Batch reverse geocoding"),
+            callback=self.batchReverseGeocoding,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow()
+        )
+        icon_path = os.path.join(ICONS, "icon_geocode.png")
+        self.add_action(
+            icon_path,
+            text=self.tr("Geocode a file"),
+            callback=self.fileGeocoding,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow()
+        )
+        self.add_action(
+            "",
+            text=self.tr("Import BAN addresses for offline use"),
+            callback=self.importAddresses,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow()
+        )
+        self.add_action(
+            "",
+            text=self.tr("Request statistics"),
+            callback=self.showStats,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow()
+        )
+        self.add_action(
+            "",
+            text=self.tr("Settings"),
+            callback=self.showSettings,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow()
+        )
         
     def geocoding(self):
-        self.rb.reset(QgsWkbTypes.PointGeometry)
-        address, ok = QInputDialog.getText(self.iface.mainWindow(), self.tr("Address"), self.tr("Input address to geocode:"))
-        if ok and address:
-            self.doGeocoding(address)
-         
-    def doGeocoding(self, address):
-        address = unicodedata.normalize('NFKD', unicode(address))
-        url = "http://api-adresse.data.gouv.fr/search/?q="+address.replace(" ", "%20")
-        
-        result = self.request(url)
+        self.searchBox.setFocus()
+        self.searchBox.selectAll()
 
+    def searchLocation(self):
+        ''' center of the map when the suggestions are biased towards it and the map is zoomed in enough
+        '''
+        if not settings.value('search/canvasBias'):
+            return None
+        from .transforms import toWgs84
         try:
-            data = json.loads(result)
-            features = data["features"]
-            if len(features) > 0:
-                feature_list = []
-                for feature in features:
-                    feature_list.append(feature["properties"]["label"]+" - "+str(round(feature["properties"]["score"]*100))+"%")
-                feature, ok = QInputDialog.getItem(self.iface.mainWindow(), self.tr("Result"), "", feature_list)
-                if ok:
-                    index = feature_list.index(feature)
-                    x = features[index]["geometry"]["coordinates"][0]
-                    y = features[index]["geometry"]["coordinates"][1]
-                    transform = QgsCoordinateTransform(QgsCoordinateReferenceSystem(4326), 
-                                                        self.canvas.mapSettings().destinationCrs(), QgsProject().instance())
-                    point = transform.transform(x, y)
-                    self.rb.addPoint(point)
-                    self.iface.mapCanvas().setCenter(point)
-                    self.iface.mapCanvas().refresh()
-            else:
-                QMessageBox.information(self.iface.mainWindow(), self.tr("Result"), self.tr("No result."))
-        except ValueError:
-            QMessageBox.critical(self.iface.mainWindow(), self.tr("Error"), self.tr("An error occured. Check your network settings (proxy)."))
+            extent = toWgs84(self.canvas.mapSettings().destinationCrs()).transformBoundingBox(self.canvas.extent())
+        except QgsCsException:
+            return None
+        if extent.isEmpty() or extent.width() > MAX_BIAS_EXTENT:
+            return None
+        return extent.center().x(), extent.center().y()
+
+    def showResult(self, feature):
+        from .parsing import FeatureArrays
+        from .resultlayer import ResultLayer
+        from .transforms import fromWgs84
+        if self.results is None:
+            self.results = ResultLayer(self.tr("Gban results"))
+        self.results.add(FeatureArrays.fromGeoJson({"features": [feature]}, ("type",)))
+        x = feature["geometry"]["coordinates"][0]
+        y = feature["geometry"]["coordinates"][1]
+        point = fromWgs84(self.canvas.mapSettings().destinationCrs()).transform(x, y)
+        self.iface.mapCanvas().setCenter(point)
+        self.iface.mapCanvas().refresh()
+
+    def searchFailed(self, response):
+        self.iface.messageBar().pushMessage(self.tr("Error"), self.errorMessage(response), level=Qgis.Warning, duration=5)
+
+    def errorMessage(self, response):
+        if response.status is not None and response.status >= 400:
+            return self.tr("The geocoder answered with the HTTP error {}, try again later.").format(response.status)
+        return self.tr("An error occured. Check your network settings (proxy).")
+
+    def batchGeocoding(self):
+        from .batch import BatchError, BatchGeocodingTask
+        from .batchdialog import BatchGeocodingDialog
+        dialog = BatchGeocodingDialog(self.iface.mainWindow())
+        if dialog.exec_():
+            layer, columns, filterColumns = dialog.layer(), dialog.columns(), dialog.filterColumns()
+            areas = None
+            if dialog.areaLayer() is not None:
+                from .areas import ReferenceAreas
+                areas = ReferenceAreas(dialog.areaLayer(), dialog.areaFields(), layer.crs(), QgsProject.instance().transformContext())
+            def geocoder():
+                return self.engine().batchGeocoder(columns, settings.value('batch/chunkSize'), filterColumns,
+                                                   settings.value('batch/minScore'), settings.value('batch/retryType'),
+                                                   areas.filters() if areas is not None else None)
+            if not dialog.incremental.isChecked():
+                task = BatchGeocodingTask(layer, columns, geocoder(), areas)
+                task.layerReady.connect(QgsProject.instance().addMapLayer)
+                self.addTask(task)
+                return
+            from .incremental import EditWatcher, IncrementalGeocodingTask
+            try:
+                task = IncrementalGeocodingTask(layer, geocoder(), areas=areas)
+            except BatchError as e:
+                self.batchError(str(e))
+                return
+            task.updated.connect(self.layerUpdated)
+            self.addTask(task)
+            if layer.id() in self.watchers:
+                self.watchers.pop(layer.id()).stop()
+            if dialog.watches():
+                self.watchers[layer.id()] = EditWatcher(layer, geocoder, self.addTask, areas)
+                layer.willBeDeleted.connect(lambda layerId=layer.id(): self.watchers.pop(layerId, None))
+
+    def layerUpdated(self, name, count):
+        self.iface.messageBar().pushMessage(self.tr("Batch geocoding"), self.tr("{} features of {} geocoded.").format(count, name),
+                                            level=Qgis.Success)
+
+    def batchReverseGeocoding(self):
+        from .batch import BatchReverseGeocodingTask
+        from .batchdialog import BatchReverseGeocodingDialog
+        dialog = BatchReverseGeocodingDialog(self.iface.mainWindow())
+        if dialog.exec_():
+            geocoder = self.engine().batchReverseGeocoder(settings.value('batch/chunkSize'), settings.value('batch/reverseTolerance'))
+            self.addTask(BatchReverseGeocodingTask(dialog.layer(), geocoder))
+
+    def fileGeocoding(self):
+        from .batchdialog import FileGeocodingDialog
+        from .pipeline import FileGeocodingTask
+        dialog = FileGeocodingDialog(self.iface.mainWindow())
+        if dialog.exec_():
+            geocoder = self.engine().batchGeocoder(dialog.columns(), settings.value('batch/chunkSize'), dialog.filterColumns(),
+                                                  settings.value('batch/minScore'), settings.value('batch/retryType'))
+            task = FileGeocodingTask(dialog.inputPath(), dialog.outputPath(), dialog.columns(), geocoder,
+                                     dialog.inputLayer(), dialog.outputLayer.text())
+            task.written.connect(self.fileGeocoded)
+            self.addTask(task)
+
+    def fileGeocoded(self, path, layerName, count):
+        QgsProject.instance().addMapLayer(QgsVectorLayer("{}|layername={}".format(path, layerName), layerName, "ogr"))
+        self.iface.messageBar().pushMessage(self.tr("Batch geocoding"), self.tr("{} rows written to {}.").format(count, path), level=Qgis.Success)
+
+    def addTask(self, task):
+        ''' keep a reference on the task while it runs, errors are shown in the message bar
+        '''
+        task.error.connect(self.batchError)
+        task.taskCompleted.connect(lambda: self.tasks.remove(task))
+        task.taskTerminated.connect(lambda: self.tasks.remove(task))
+        self.tasks.append(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def batchError(self, message):
+        self.iface.messageBar().pushMessage(self.tr("Error"), message, level=Qgis.Critical)
 
-    
     def reverseGeocoding(self):
+        if self.tool is None:
+            self.tool = QgsMapToolEmitPoint(self.canvas)
+            self.tool.canvasClicked.connect(self.doReverseGeocoding)
+            # The map tools check their action when activated and uncheck it when deactivated
+            self.tool.setAction(self.reverseAction)
         self.canvas.setMapTool(self.tool)
         
-    def doReverseGeocoding(self, point_orig):
-        transform = QgsCoordinateTransform(self.canvas.mapSettings().destinationCrs(), 
-                                            QgsCoordinateReferenceSystem(4326), QgsProject().instance())
-        point = transform.transform(point_orig)
-        url = "http://api-adresse.data.gouv.fr/reverse/?lon="+str(point.x())+"&lat="+str(point.y())
+    def addressOverlay(self):
+        if self.overlayTool is None:
+            from .overlay import AddressOverlayTool
+            self.overlayTool = AddressOverlayTool(self.canvas, self.engine(), self.addTask)
+            self.overlayTool.setAction(self.overlayAction)
+        self.canvas.setMapTool(self.overlayTool)
 
-        result = self.request(url)
+    def doReverseGeocoding(self, point_orig):
+        from .transforms import toWgs84
+        point = toWgs84(self.canvas.mapSettings().destinationCrs()).transform(point_orig)
+        # Only the nearest address is shown
+        self.engine().reverse(point.x(), point.y(), self.reverseGeocodingFinished, limit=1)
 
+    def reverseGeocodingFinished(self, response):
         try:
-            data = json.loads(result)
-            
-            if len(data["features"]) > 0:
-                address = data["features"][0]["properties"]["label"]
-                clicked = QMessageBox.information(self.iface.mainWindow(), self.tr("Result"), address, QMessageBox.Ok, QMessageBox.Save)
-                if clicked == QMessageBox.Save:
-                    QApplication.clipboard().setText(address)
-            else:
-                QMessageBox.information(self.iface.mainWindow(), self.tr("Result"), self.tr("No result."))
+            if response.error is not None:
+                raise ValueError(response.error)
+            data = response.json()
         except ValueError:
-            QMessageBox.critical(self.iface.mainWindow(), self.tr("Error"), self.tr("An error occured. Check your network settings (proxy)."))
+            self.showError(response)
+            return
+        self.reverseGeocodingResults(data)
 
-    def uncheckReverseGeocoding(self):
-        self.exclusive.checkedAction().setChecked(False)
+    def reverseGeocodingResults(self, data):
+        if len(data["features"]) > 0:
+            address = data["features"][0]["properties"]["label"]
+            clicked = QMessageBox.information(self.iface.mainWindow(), self.tr("Result"), address, QMessageBox.Ok, QMessageBox.Save)
+            if clicked == QMessageBox.Save:
+                QApplication.clipboard().setText(address)
+        else:
+            QMessageBox.information(self.iface.mainWindow(), self.tr("Result"), self.tr("No result."))
 
-    def request(self, url):
-        ''' prepare the request and return the result of the reply
-        '''
-        fetcher = QgsNetworkContentFetcher()
-        fetcher.fetchContent(QUrl(url))
-        evloop = QEventLoop()
-        fetcher.finished.connect(evloop.quit)
-        evloop.exec_(QEventLoop.ExcludeUserInputEvents)
-        return fetcher.contentAsString()
\ No newline at end of file
+    def importAddresses(self):
+        from .columnar import SUFFIX
+        from .indextask import OfflineImportTask
+        paths, _ = QFileDialog.getOpenFileNames(self.iface.mainWindow(), self.tr("BAN address files"), "",
+                                                self.tr("BAN addresses (*.csv *.csv.gz)"))
+        if paths:
+            if self.backend is not None and settings.offlinePath().endswith(SUFFIX):
+                if self.tasks:
+                    # A running task may be reading the address store that is about to be replaced
+                    self.iface.messageBar().pushMessage(self.tr("Offline index"), self.tr("Wait for the running tasks to finish before importing."),
+                                                        level=Qgis.Warning)
+                    return
+                self.dropBackend()
+            task = OfflineImportTask(settings.offlinePath(), paths)
+            task.imported.connect(self.addressesImported)
+            self.addTask(task)
+
+    def addressesImported(self, count):
+        # A rebuilt address store is mapped again on the next request
+        self.dropBackend()
+        if self.overlayTool is not None:
+            self.overlayTool.setBackend(self.engine())
+        self.iface.messageBar().pushMessage(self.tr("Offline index"), self.tr("{} addresses available offline.").format(count), level=Qgis.Success)
+
+    def showError(self, response):
+        QMessageBox.critical(self.iface.mainWindow(), self.tr("Error"), self.errorMessage(response))
+
+    def showStats(self):
+        if self.statsDock is None:
+            from .statsdock import StatsDock
+            self.statsDock = StatsDock(self.iface.mainWindow())
+            self.iface.addDockWidget(Qt.RightDockWidgetArea, self.statsDock)
+        self.statsDock.setUserVisible(True)
+
+    def showSettings(self):
+        from .settingsdialog import SettingsDialog
+        if SettingsDialog(self.geocodeCache(), self.iface.mainWindow()).exec_():
+            self.dropBackend()
+            self.searchBox.reset()
+            if self.overlayTool is not None:
+                self.overlayTool.setBackend(self.engine())
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from qgis.PyQt.QtCore import QObject, QVariant, pyqtSignal
+
+from qgis.core import (NULL, Qgis, QgsField, QgsFields, QgsMessageLog, QgsProject, QgsTask, QgsVectorDataProvider,
+                       QgsVectorLayerFeatureSource)
+
+import hashlib
+import json
+
+from .areas import constrain, featureRequest
+from .batch import BatchError, resultField, resultValue
+
+# Column holding the hash of the input values a result was geocoded from
+HASH_COLUMN = "gban_hash"
+
+def resultSignature(geocoder):
+    ''' settings of the geocoder changing its results, the size of the chunks does not
+    '''
+    signature = dict(geocoder.signature())
+    signature.pop("chunkSize", None)
+    return json.dumps(signature, sort_keys=True)
+
+def inputHash(values, signature):
+    ''' hash of the input values of a row and of the geocoder settings, the row is geocoded again when it changes
+    '''
+    return hashlib.sha1((json.dumps(values) + signature).encode('utf-8')).hexdigest()[:16]
+
+def addResultFields(layer, geocoder):
+    ''' add the result columns and the hash column missing from a layer, return their provider field indices
+    '''
+    provider = layer.dataProvider()
+    capabilities = QgsVectorDataProvider.AddAttributes | QgsVectorDataProvider.ChangeAttributeValues
+    if provider.capabilities() & capabilities != capabilities:
+        raise BatchError("The layer {} can not be modified".format(layer.name()))
+    columns = geocoder.outputColumns() + [HASH_COLUMN]
+    missing = [column for column in columns if provider.fields().indexOf(column) < 0]
+    if missing:
+        provider.addAttributes([QgsField(column, QVariant.String, len=16) if column == HASH_COLUMN else resultField(column)
+                                for column in missing])
+        layer.updateFields()
+    return [provider.fields().indexOf(column) for column in columns]
+
+def staleRows(features, indices, hashIndex, longitudeIndex, signature, areas=None):
+    ''' yield (id, values, hash) for the features whose input values changed since they were geocoded,
+        the new ones and those left without result. A feature moved to another reference area changes too
+    '''
+    for feature in features:
+        values = constrain(['' if feature[i] == NULL else str(feature[i]) for i in indices], feature, areas)
+        digest = inputHash(values, signature)
+        if feature[hashIndex] != digest or feature[longitudeIndex] == NULL:
+            yield feature.id(), values, digest
+
+def geocodeStale(geocoder, features, fields, isCanceled=lambda: False, areas=None):
+    ''' geocode the stale features and yield (id, values) with the values of the output columns
+        followed by the input hash. fields are those of the features, result fields included
+    '''
+    columns = geocoder.outputColumns()
+    digests = {}
+    def rows():
+        for rowId, values, digest in staleRows(features, [fields.indexOf(column) for column in geocoder.inputColumns()],
+                                               fields.indexOf(HASH_COLUMN), fields.indexOf("longitude"), resultSignature(geocoder), areas):
+            digests[rowId] = digest
+            yield rowId, values
+    for rowId, result in geocoder.geocode(rows(), isCanceled):
+        yield rowId, [resultValue(column, result[column]) for column in columns] + [digests.pop(rowId)]
+
+class IncrementalGeocodingTask(QgsTask):
+    ''' geocode in background the features of a layer whose address changed, the new ones and those
+        left without result, and write the results to the layer. fids restricts the features looked at
+    '''
+
+    updated = pyqtSignal(str, int)
+    error = pyqtSignal(str)
+
+    def __init__(self, layer, geocoder, fids=None, areas=None):
+        super().__init__("Gban - " + layer.name(), QgsTask.CanCancel)
+        self.layerId = layer.id()
+        self.name = layer.name()
+        self.geocoder = geocoder
+        self.areas = areas
+        # Fields are added from the main thread, before the layer is read
+        self.indices = addResultFields(layer, geocoder)
+        self.fields = QgsFields(layer.fields())
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.request = featureRequest(areas)
+        if fids is not None:
+            self.request.setFilterFids(list(fids))
+        self.total = len(fids) if fids is not None else layer.featureCount()
+        self.changes = {}
+        self.exception = None
+
+    def run(self):
+        try:
+            for count, (rowId, values) in enumerate(geocodeStale(self.geocoder, self.source.getFeatures(self.request), self.fields,
+                                                                 self.isCanceled, self.areas), 1):
+                self.changes[rowId] = dict(zip(self.indices, values))
+                self.setProgress(100 * count / max(self.total, 1))
+        except BatchError as e:
+            self.exception = e
+            return False
+        return not self.isCanceled()
+
+    def finished(self, result):
+        # Results are written even when interrupted, the next run goes on with the remaining features
+        layer = QgsProject.instance().mapLayer(self.layerId)
+        if layer is not None and self.changes:
+            layer.dataProvider().changeAttributeValues(self.changes)
+            layer.triggerRepaint()
+        if self.exception is not None:
+            self.error.emit(str(self.exception))
+        elif result:
+            self.updated.emit(self.name, len(self.changes))
+
+class EditWatcher(QObject):
+    ''' geocode the features added to a layer or modified once their edits are committed.
+        geocoder is a function returning a new batch geocoder, addTask runs a task
+    '''
+
+    def __init__(self, layer, geocoder, addTask, areas=None, parent=None):
+        super().__init__(parent)
+        self.layer = layer
+        self.geocoder = geocoder
+        self.addTask = addTask
+        self.areas = areas
+        layer.committedFeaturesAdded.connect(self.added)
+        layer.committedAttributeValuesChanges.connect(self.changed)
+        layer.willBeDeleted.connect(self.stop)
+
+    def added(self, layerId, features):
+        self.geocode([feature.id() for feature in features])
+
+    def changed(self, layerId, changes):
+        # The features whose address did not change are skipped by staleRows
+        self.geocode(list(changes.keys()))
+
+    def geocode(self, fids):
+        if not fids:
+            return
+        try:
+            self.addTask(IncrementalGeocodingTask(self.layer, self.geocoder(), fids, self.areas))
+        except BatchError as e:
+            QgsMessageLog.logMessage(str(e), 'Gban', Qgis.Warning)
+
+    def stop(self):
+        if self.layer is not None:
+            self.layer.committedFeaturesAdded.disconnect(self.added)
+            self.layer.committedAttributeValuesChanges.disconnect(self.changed)
+            self.layer.willBeDeleted.disconnect(self.stop)
+            self.layer = None
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import pyqtSignal
+
+from qgis.core import QgsTask
+
+from .columnar import SUFFIX, buildColumnar
+from .offline import OfflineIndex
+
+class OfflineImportTask(QgsTask):
+    ''' import BAN csv exports into the offline index in background.
+        An address store (.gban) is rebuilt from the given exports
+    '''
+
+    imported = pyqtSignal(int)
+    error = pyqtSignal(str)
+
+    def __init__(self, path, paths):
+        super().__init__("Gban - Import BAN addresses", QgsTask.CanCancel)
+        self.path = path
+        self.paths = paths
+        self.count = 0
+        self.exception = None
+
+    def run(self):
+        if self.path.endswith(SUFFIX):
+            try:
+                self.count = buildColumnar(self.paths, self.path, lambda fraction: self.setProgress(100 * fraction), self.isCanceled)
+            except InterruptedError:
+                return False
+            except (OSError, KeyError, ValueError) as e:
+                self.exception = e
+                return False
+            return True
+        # The index gets its own connection, sqlite connections can not be shared between threads
+        index = OfflineIndex(self.path)
+        try:
+            index.importCsv(self.paths, lambda fraction: self.setProgress(100 * fraction), self.isCanceled)
+            self.count = index.count()
+        except InterruptedError:
+            return False
+        except (OSError, KeyError, ValueError) as e:
+            self.exception = e
+            return False
+        finally:
+            index.close()
+        return True
+
+    def finished(self, result):
+        if result:
+            self.imported.emit(self.count)
+        elif self.exception is not None:
+            self.error.emit(str(self.exception))
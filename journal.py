@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, rows INTEGER, answers TEXT, finished REAL);
+"""
+
+def jobName(signature):
+    ''' file name of the journal of a job, derived from everything that defines its chunks
+    '''
+    return hashlib.sha1(json.dumps(signature, sort_keys=True).encode('utf-8')).hexdigest() + '.sqlite'
+
+class Journal:
+    ''' record the answers of every committed chunk of a batch job so that an interrupted run
+        can replay them instead of sending them again, and measure the throughput of the run
+    '''
+
+    def __init__(self, path, signature, total=None, report=lambda journal: None):
+        self.path = path
+        self.total = total
+        self.report = report
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        signature = json.dumps(signature, sort_keys=True)
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        if row is None or row[0] != signature:
+            with self.connection:
+                self.connection.execute("DELETE FROM chunks")
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,))
+        self.committedRows = self.connection.execute("SELECT coalesce(sum(rows), 0) FROM chunks").fetchone()[0]
+        self.resumedRows = self.committedRows
+        self.started = time.monotonic()
+        self.sessionRows = 0
+
+    def answers(self, number):
+        ''' return the answers of a committed chunk, or None
+        '''
+        row = self.connection.execute("SELECT answers FROM chunks WHERE id = ?", (number,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def commit(self, number, rows, answers):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)", (number, rows, json.dumps(answers), time.time()))
+        self.committedRows += rows
+        self.sessionRows += rows
+        self.report(self)
+
+    def throughput(self):
+        ''' rows per second geocoded during this run, replayed chunks excluded
+        '''
+        elapsed = time.monotonic() - self.started
+        return self.sessionRows / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        ''' estimated seconds before the end of the job, or None when unknown
+        '''
+        rate = self.throughput()
+        if self.total is None or rate <= 0:
+            return None
+        return max(0, self.total - self.committedRows) / rate
+
+    def summary(self):
+        eta = self.eta()
+        return "{} / {} rows, {:.0f} rows/s, {} remaining".format(
+            self.committedRows, self.total if self.total is not None else "?", self.throughput(),
+            timedelta(seconds=int(eta)) if eta is not None else "?")
+
+    def close(self):
+        self.connection.close()
+
+    def remove(self):
+        ''' drop the journal once the job is complete
+        '''
+        self.close()
+        os.remove(self.path)
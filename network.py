@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QObject, QTimer, QUrl
+from qgis.PyQt.QtNetwork import QNetworkReply, QNetworkRequest
+
+from qgis.core import QgsNetworkAccessManager
+
+from collections import deque
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+
+from . import settings
+from .parsing import loads
+from .stats import stats
+
+# Statuses sent by the BAN API when it is overloaded or throttling the client
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    ''' rate limiter allowing rate requests per second on average and bursts of burst requests,
+        shared between the interface and the batch threads
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.setRate(rate, burst)
+
+    def setRate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            self.capacity = burst or max(1.0, rate)
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+
+    def tryAcquire(self):
+        ''' take a token and return 0, or return the seconds to wait for the next one
+        '''
+        with self.lock:
+            if self.rate <= 0:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        ''' block until a token is available
+        '''
+        wait = self.tryAcquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.tryAcquire()
+
+limiter = TokenBucket(settings.value('network/rate'))
+
+def retryDelay(attempt, retryAfter=None, base=0.5, cap=60.0):
+    ''' seconds to wait before the next attempt: the Retry-After header when the server sent one,
+        otherwise an exponential backoff with full jitter
+    '''
+    if retryAfter:
+        try:
+            return min(cap, max(0.0, float(retryAfter)))
+        except ValueError:
+            try:
+                return min(cap, max(0.0, parsedate_to_datetime(retryAfter).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def shouldRetry(status, attempt):
+    return status in RETRY_STATUSES and attempt < settings.value('network/maxRetries')
+
+class Response:
+    ''' answer of a backend, data is the decoded GeoJSON when the backend did not answer with raw content
+    '''
+
+    def __init__(self, content=b'', status=None, error=None, retries=0, data=None):
+        self.content = content
+        self.status = status
+        self.error = error
+        self.retries = retries
+        self.data = data
+
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        if self.data is None:
+            self.data = loads(self.content)
+        return self.data
+
+class Request:
+    ''' handle on a queued or running request
+    '''
+
+    def __init__(self, queue, url, callback):
+        self.queue = queue
+        self.url = url
+        self.callback = callback
+        self.aborted = False
+
+    def abort(self):
+        if not self.aborted:
+            self.aborted = True
+            self.queue.release(self)
+
+class Transfer:
+    ''' network transfer shared by the identical requests made while it is queued or running
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.requests = []
+        self.reply = None
+        self.attempt = 0
+        self.started = None
+
+class RequestQueue(QObject):
+    ''' run GET requests asynchronously, at most maxConcurrent at a time,
+        and call back with a Response once each one is finished.
+        Identical requests made while one is in flight are coalesced into a single transfer.
+        Transfers are started at the pace of the rate limiter and throttled ones are retried
+    '''
+
+    def __init__(self, maxConcurrent=4, parent=None):
+        super().__init__(parent)
+        self.maxConcurrent = maxConcurrent
+        self.transfers = {}
+        self.pending = deque()
+        self.running = set()
+        self.waiting = False
+
+    def get(self, url, callback):
+        request = Request(self, url, callback)
+        transfer = self.transfers.get(url)
+        if transfer is None:
+            transfer = self.transfers[url] = Transfer(url)
+            self.pending.append(transfer)
+        transfer.requests.append(request)
+        self.next()
+        return request
+
+    def release(self, request):
+        ''' forget an aborted request, its transfer is aborted when nobody else waits for it
+        '''
+        transfer = self.transfers.get(request.url)
+        if transfer is None or request not in transfer.requests:
+            return
+        transfer.requests.remove(request)
+        if not transfer.requests:
+            del self.transfers[transfer.url]
+            if transfer.reply is not None:
+                transfer.reply.abort()
+
+    def abortAll(self):
+        for transfer in list(self.transfers.values()):
+            for request in list(transfer.requests):
+                request.abort()
+        self.pending.clear()
+
+    def next(self):
+        if self.waiting:
+            return
+        while self.pending and len(self.running) < self.maxConcurrent:
+            if not self.pending[0].requests:
+                self.pending.popleft()
+                continue
+            wait = limiter.tryAcquire()
+            if wait:
+                self.waiting = True
+                QTimer.singleShot(int(wait * 1000) + 1, self.resume)
+                return
+            transfer = self.pending.popleft()
+            request = QNetworkRequest(QUrl(transfer.url))
+            request.setRawHeader(b'Connection', b'keep-alive')
+            transfer.started = time.monotonic()
+            transfer.reply = QgsNetworkAccessManager.instance().get(request)
+            transfer.reply.finished.connect(lambda transfer=transfer: self.finished(transfer))
+            self.running.add(transfer)
+
+    def resume(self):
+        self.waiting = False
+        self.next()
+
+    def retry(self, transfer):
+        if transfer.requests:
+            self.pending.appendleft(transfer)
+            self.next()
+
+    def finished(self, transfer):
+        reply = transfer.reply
+        self.running.discard(transfer)
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if transfer.requests and shouldRetry(status, transfer.attempt):
+            delay = retryDelay(transfer.attempt, bytes(reply.rawHeader(b'Retry-After')).decode('latin-1'))
+            transfer.attempt += 1
+            transfer.reply = None
+            reply.deleteLater()
+            QTimer.singleShot(int(delay * 1000), lambda: self.retry(transfer))
+            self.next()
+            return
+        if self.transfers.get(transfer.url) is transfer:
+            del self.transfers[transfer.url]
+        try:
+            if transfer.requests:
+                error = reply.errorString() if reply.error() != QNetworkReply.NoError else None
+                response = Response(bytes(reply.readAll()), status, error, transfer.attempt)
+                stats.record(transfer.url, time.monotonic() - transfer.started, len(response.content), status, transfer.attempt, error)
+                for request in list(transfer.requests):
+                    request.callback(response)
+        finally:
+            reply.deleteLater()
+            self.next()
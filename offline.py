@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module does not depend on QGIS so that the index can be queried from worker processes
+
+import csv
+import gzip
+import io
+import math
+import os
+import re
+import sqlite3
+
+from .cache import normalize
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS address (
+    id INTEGER PRIMARY KEY, ban_id TEXT UNIQUE, label TEXT, housenumber TEXT, street TEXT,
+    postcode TEXT, citycode TEXT, city TEXT, lon REAL, lat REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS address_fts USING fts5(
+    label, content='address', content_rowid='id', detail='none', tokenize="unicode61 remove_diacritics 2"
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS address_rtree USING rtree(id, minLon, maxLon, minLat, maxLat);
+"""
+
+EARTH_RADIUS = 6371008.8
+
+# Half size in degrees of the first window searched around a reverse geocoded point,
+# doubled until enough addresses are found or the maximum is reached
+REVERSE_WINDOW = 0.0005
+REVERSE_MAX_WINDOW = 0.1
+
+# Number of candidate addresses kept for each query
+CANDIDATES = 50
+# Number of full text matches rescored for each query, the shortest labels are kept when there are more
+MATCHES = 1000
+
+FILTERS = ('postcode', 'citycode')
+
+def tokenize(text):
+    return re.findall(r'\w+', normalize(text))
+
+def similarity(queryTokens, label):
+    ''' Dice coefficient between the query tokens and the label tokens, between 0 and 1
+    '''
+    labelTokens = tokenize(label)
+    remaining = list(labelTokens)
+    matched = 0
+    for token in queryTokens:
+        if token in remaining:
+            remaining.remove(token)
+            matched += 1
+    return 2.0 * matched / (len(queryTokens) + len(labelTokens))
+
+def distance(lon1, lat1, lon2, lat2):
+    ''' equirectangular approximation in meters, accurate enough at the scale of a neighbourhood
+    '''
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * EARTH_RADIUS
+
+def feature(row, score):
+    ''' GeoJSON feature of an address row (ban_id, label, housenumber, street, postcode, citycode, city, lon, lat)
+    '''
+    banId, label, housenumber, street, postcode, citycode, city, lon, lat = row
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+        "properties": {
+            "label": label, "score": score, "id": banId, "type": "housenumber" if housenumber else "street",
+            "housenumber": housenumber, "name": ' '.join(filter(None, [housenumber, street])), "street": street,
+            "postcode": postcode, "citycode": citycode, "city": city,
+        },
+    }
+
+def nearestFeatures(lon, lat, limit, addressesIn, row=lambda item: item):
+    ''' nearest addresses as a GeoJSON FeatureCollection shaped like the /reverse/ answer of the BAN API.
+        addressesIn(minLon, maxLon, minLat, maxLat) returns the (lon, lat, item) of the addresses in a box
+        and row(item) the address row of an item
+    '''
+    scale = math.cos(math.radians(lat))
+    window = REVERSE_WINDOW
+    while True:
+        found = sorted((distance(lon, lat, x, y), item)
+                       for x, y, item in addressesIn(lon - window / scale, lon + window / scale, lat - window, lat + window))
+        # Only the addresses within the inscribed circle of the window are surely the nearest ones
+        radius = math.radians(window) * EARTH_RADIUS
+        nearest = [(meters, item) for meters, item in found if meters <= radius]
+        if len(nearest) >= limit or window >= REVERSE_MAX_WINDOW:
+            break
+        window *= 2
+    if len(nearest) < limit:
+        nearest = found
+    features = []
+    for meters, item in nearest[:limit]:
+        result = feature(row(item), max(0.0, 1.0 - meters / 1000))
+        result["properties"]["distance"] = round(meters)
+        features.append(result)
+    return {"type": "FeatureCollection", "features": features}
+
+def readBanCsv(path):
+    ''' yield (raw file, row) for every address of a BAN csv export, plain or gzipped
+    '''
+    raw = open(path, 'rb')
+    with raw:
+        stream = gzip.GzipFile(fileobj=raw) if path.endswith('.gz') else raw
+        for row in csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig'), delimiter=';'):
+            yield raw, row
+
+class OfflineIndex:
+    ''' local index of BAN addresses answering search queries like the BAN API
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        # Indexes built before the spatial index existed only have their addresses
+        if self.connection.execute("SELECT 1 FROM address_rtree LIMIT 1").fetchone() is None:
+            with self.connection:
+                self.connection.execute("INSERT INTO address_rtree SELECT id, lon, lon, lat, lat FROM address")
+
+    def importCsv(self, paths, progress=lambda fraction: None, isCanceled=lambda: False):
+        ''' import BAN address csv exports (adresses-XX.csv[.gz]), existing addresses are kept
+        '''
+        lastId = self.connection.execute("SELECT coalesce(max(id), 0) FROM address").fetchone()[0]
+        self.connection.execute("PRAGMA synchronous=OFF")
+        with self.connection:
+            for index, path in enumerate(paths):
+                size = max(os.path.getsize(path), 1)
+                batch = []
+                for raw, row in readBanCsv(path):
+                    housenumber = ' '.join(filter(None, [row['numero'], row['rep']]))
+                    label = ' '.join(filter(None, [housenumber, row['nom_voie'], row['code_postal'], row['nom_commune']]))
+                    batch.append((row['id'], label, housenumber, row['nom_voie'], row['code_postal'],
+                                  row['code_insee'], row['nom_commune'], float(row['lon']), float(row['lat'])))
+                    if len(batch) == 10000:
+                        self.insert(batch)
+                        batch = []
+                        if isCanceled():
+                            raise InterruptedError()
+                        progress((index + raw.tell() / size) / len(paths))
+                self.insert(batch)
+            self.connection.execute("INSERT INTO address_fts (rowid, label) SELECT id, label FROM address WHERE id > ?", (lastId,))
+            self.connection.execute("INSERT INTO address_rtree SELECT id, lon, lon, lat, lat FROM address WHERE id > ?", (lastId,))
+        self.connection.execute("PRAGMA synchronous=FULL")
+        progress(1.0)
+
+    def insert(self, batch):
+        self.connection.executemany("INSERT OR IGNORE INTO address (ban_id, label, housenumber, street, postcode, citycode, city, lon, lat) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+
+    def count(self):
+        return self.connection.execute("SELECT count(*) FROM address").fetchone()[0]
+
+    def candidates(self, match, filters, limit):
+        ''' (id, ban_id, label) of at most limit full text matches
+        '''
+        sql = "SELECT a.id, a.ban_id, a.label FROM address_fts f JOIN address a ON a.id = f.rowid WHERE address_fts MATCH ?"
+        parameters = [match]
+        for name in sorted(filters):
+            if name not in FILTERS:
+                raise ValueError("Unknown filter: " + name)
+            sql += " AND a.{} = ?".format(name)
+            parameters.append(filters[name])
+        matches = self.connection.execute(sql + " LIMIT ?", parameters + [limit + 1]).fetchall()
+        if len(matches) > limit:
+            # Too many to rescore them all, the shortest labels are kept: when every token of the query
+            # is found in a label, its similarity only decreases with its length
+            matches = self.connection.execute(sql + " ORDER BY length(a.label), a.id LIMIT ?", parameters + [limit]).fetchall()
+        return matches
+
+    def rows(self, ids):
+        ''' address rows of ids, in the same order
+        '''
+        if not ids:
+            return []
+        rows = {row[0]: row[1:] for row in self.connection.execute(
+            "SELECT id, ban_id, label, housenumber, street, postcode, citycode, city, lon, lat FROM address WHERE id IN ({})".format(
+                ','.join('?' * len(ids))), ids)}
+        return [rows[i] for i in ids]
+
+    def search(self, query, limit=5, **filters):
+        ''' return a GeoJSON FeatureCollection shaped like the /search/ answer of the BAN API,
+            filters can be postcode or citycode
+        '''
+        tokens = tokenize(query)
+        rows = []
+        if tokens:
+            quoted = ['"{}"'.format(token) for token in tokens]
+            # All the tokens should match, otherwise allow one of them to be missing (typo, unknown word).
+            # Conjunctions stay fast on large indexes where a single token like "rue" matches most rows
+            rows = self.candidates(' AND '.join(quoted), filters, MATCHES)
+            if not rows and len(quoted) > 1:
+                for i in range(len(quoted)):
+                    rows += self.candidates(' AND '.join(quoted[:i] + quoted[i + 1:]), filters, MATCHES)
+        # Every match is rescored before the best ones are kept.
+        # Ties are ordered by BAN id so that every process and every run ranks them the same
+        scored = sorted(((similarity(tokens, label), banId, rowId) for rowId, banId, label in dict.fromkeys(rows)),
+                        key=lambda item: (-item[0], item[1]))[:limit]
+        return {
+            "type": "FeatureCollection",
+            "query": query,
+            "features": [feature(row, score) for (score, banId, rowId), row in zip(scored, self.rows([rowId for score, banId, rowId in scored]))],
+        }
+
+    def reverse(self, lon, lat, limit=1):
+        ''' return the nearest addresses as a GeoJSON FeatureCollection shaped like the /reverse/ answer of the BAN API
+        '''
+        return nearestFeatures(lon, lat, limit, self.addressesIn)
+
+    def addressesIn(self, minLon, maxLon, minLat, maxLat):
+        rows = self.connection.execute(
+            "SELECT a.ban_id, a.label, a.housenumber, a.street, a.postcode, a.citycode, a.city, a.lon, a.lat "
+            "FROM address_rtree r JOIN address a ON a.id = r.id "
+            "WHERE r.minLon <= ? AND r.maxLon >= ? AND r.minLat <= ? AND r.maxLat >= ?",
+            (maxLon, minLon, maxLat, minLat)).fetchall()
+        return [(row[7], row[8], row) for row in rows]
+
+    def close(self):
+        self.connection.close()
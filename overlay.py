@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QCoreApplication, QTimer, pyqtSignal
+from qgis.PyQt.QtWidgets import QToolTip
+
+from qgis.core import QgsCsException, QgsTask
+from qgis.gui import QgsMapTool
+
+from collections import OrderedDict
+import math
+
+from .batch import BatchError
+from .transforms import toWgs84
+
+# Sample points per tile side, the addresses of GRID x GRID points are fetched for every tile
+GRID = 4
+# Tiles are not fetched above this size in degrees, the grid would be too coarse to be useful
+MAX_TILE_SIZE = 0.02
+# At most this many tiles per side of the visible extent, plus the partly visible ones
+TILES_PER_VIEW = 4
+# Result columns of the sample points: the position of the address found and its label
+SAMPLE_COLUMNS = ["longitude", "latitude", "result_label"]
+
+def tileLevel(width):
+    ''' level of the tiles for an extent width in degrees, a tile of level z is 360 / 2^z degrees wide
+    '''
+    return max(0, math.floor(math.log2(360 * TILES_PER_VIEW / max(width, 1e-9))))
+
+def tileSize(level):
+    return 360 / 2 ** level
+
+def tileKey(lon, lat, level):
+    size = tileSize(level)
+    return level, math.floor((lon + 180) / size), math.floor((lat + 90) / size)
+
+def tilesCovering(xMin, yMin, xMax, yMax, level):
+    _, x0, y0 = tileKey(xMin, yMin, level)
+    _, x1, y1 = tileKey(xMax, yMax, level)
+    return [(level, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+def samplePoints(key):
+    ''' centers of the GRID x GRID cells of a tile
+    '''
+    level, x, y = key
+    size = tileSize(level)
+    step = size / GRID
+    return [(x * size - 180 + (i + 0.5) * step, y * size - 90 + (j + 0.5) * step) for i in range(GRID) for j in range(GRID)]
+
+class TileCache:
+    ''' addresses found for the sample points of the fetched tiles, the least recently used tiles are dropped above maxTiles
+    '''
+
+    def __init__(self, maxTiles=2000):
+        self.maxTiles = maxTiles
+        self.tiles = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def put(self, key, samples):
+        ''' samples are the (lon, lat, label) addresses found for the sample points of the tile
+        '''
+        self.tiles[key] = samples
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.maxTiles:
+            self.tiles.popitem(last=False)
+
+    def nearest(self, lon, lat, level):
+        ''' label of the address nearest to a position, None when its tile is not fetched yet
+        '''
+        samples = self.tiles.get(tileKey(lon, lat, level))
+        if not samples:
+            return None
+        scale = math.cos(math.radians(lat)) ** 2
+        return min(samples, key=lambda sample: (sample[0] - lon) ** 2 * scale + (sample[1] - lat) ** 2)[2]
+
+    def clear(self):
+        self.tiles.clear()
+
+class TilePrefetchTask(QgsTask):
+    ''' reverse geocode the sample points of tiles in background, in a single batch
+    '''
+
+    prefetched = pyqtSignal(dict)
+    error = pyqtSignal(str)
+
+    def __init__(self, tiles, geocoder):
+        super().__init__("Gban - Address overlay", QgsTask.CanCancel)
+        self.tiles = tiles
+        self.geocoder = geocoder
+        self.samples = {}
+        self.exception = None
+
+    def run(self):
+        points = [(key, point) for key in self.tiles for point in samplePoints(key)]
+        rows = ((rowId, ["{:.7f}".format(lon), "{:.7f}".format(lat)]) for rowId, (key, (lon, lat)) in enumerate(points))
+        addresses = {key: {} for key in self.tiles}
+        try:
+            for rowId, result in self.geocoder.geocode(rows, self.isCanceled):
+                # Neighbouring sample points often find the same address, it is kept once
+                if result["longitude"] and result["latitude"] and result["result_label"]:
+                    address = (float(result["longitude"]), float(result["latitude"]), result["result_label"])
+                    addresses[points[rowId][0]][address] = None
+        except BatchError as e:
+            self.exception = e
+            return False
+        self.samples = {key: list(tileAddresses) for key, tileAddresses in addresses.items()}
+        return not self.isCanceled()
+
+    def finished(self, result):
+        if result:
+            self.prefetched.emit(self.samples)
+        elif self.exception is not None:
+            self.error.emit(str(self.exception))
+
+class AddressOverlayTool(QgsMapTool):
+    ''' show the nearest address under the cursor. The addresses of a grid of points are prefetched
+        for the tiles of the visible extent each time it changes, hovering only reads the cache
+    '''
+
+    def __init__(self, canvas, backend, addTask):
+        super().__init__(canvas)
+        self.backend = backend
+        self.addTask = addTask
+        self.cache = TileCache()
+        self.pending = set()
+        self.level = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.prefetch)
+
+    def tr(self, message):
+        return QCoreApplication.translate('Gban', message)
+
+    def setBackend(self, backend):
+        self.backend = backend
+        self.cache.clear()
+
+    def activate(self):
+        super().activate()
+        self.canvas().extentsChanged.connect(self.schedule)
+        self.prefetch()
+
+    def deactivate(self):
+        self.canvas().extentsChanged.disconnect(self.schedule)
+        self.timer.stop()
+        super().deactivate()
+
+    def schedule(self):
+        # Wait for the end of a pan or zoom
+        self.timer.start(300)
+
+    def prefetch(self):
+        try:
+            extent = toWgs84(self.canvas().mapSettings().destinationCrs()).transformBoundingBox(self.canvas().extent())
+        except QgsCsException:
+            return
+        self.level = tileLevel(extent.width())
+        if tileSize(self.level) > MAX_TILE_SIZE:
+            return
+        tiles = [key for key in tilesCovering(extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(), self.level)
+                 if key not in self.cache and key not in self.pending]
+        if not tiles:
+            return
+        self.pending.update(tiles)
+        geocoder = self.backend.batchReverseGeocoder(len(tiles) * GRID * GRID, resultColumns=SAMPLE_COLUMNS)
+        task = TilePrefetchTask(tiles, geocoder)
+        task.prefetched.connect(self.prefetched)
+        task.taskCompleted.connect(lambda: self.pending.difference_update(tiles))
+        task.taskTerminated.connect(lambda: self.pending.difference_update(tiles))
+        self.addTask(task)
+
+    def prefetched(self, samples):
+        for key, tileSamples in samples.items():
+            self.cache.put(key, tileSamples)
+
+    def canvasMoveEvent(self, event):
+        if self.level is None or tileSize(self.level) > MAX_TILE_SIZE:
+            QToolTip.showText(event.globalPos(), self.tr("Zoom in to see the addresses"), self.canvas())
+            return
+        try:
+            point = toWgs84(self.canvas().mapSettings().destinationCrs()).transform(event.mapPoint())
+        except QgsCsException:
+            return
+        label = self.cache.nearest(point.x(), point.y(), self.level)
+        if label:
+            QToolTip.showText(event.globalPos(), label, self.canvas())
+        else:
+            QToolTip.hideText()
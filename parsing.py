@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+import csv
+import io
+import json
+
+# orjson parses several times faster than the json module, it is used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(content):
+    ''' decode a JSON answer given as bytes
+    '''
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content.decode('utf-8'))
+
+class FeatureArrays:
+    ''' label, score and coordinates of the features of a BAN GeoJSON answer in compact arrays,
+        along with the selected properties. Features are only rebuilt as dicts on demand
+    '''
+
+    __slots__ = ('labels', 'scores', 'lons', 'lats', 'properties')
+
+    def __init__(self, properties=()):
+        self.labels = []
+        self.scores = array('d')
+        self.lons = array('d')
+        self.lats = array('d')
+        self.properties = {name: [] for name in properties}
+
+    @classmethod
+    def fromGeoJson(cls, data, properties=()):
+        arrays = cls(properties)
+        features = data["features"]
+        arrays.labels = [feature["properties"]["label"] for feature in features]
+        arrays.scores = array('d', [feature["properties"].get("score") or 0.0 for feature in features])
+        coordinates = [feature["geometry"]["coordinates"] for feature in features]
+        arrays.lons = array('d', [point[0] for point in coordinates])
+        arrays.lats = array('d', [point[1] for point in coordinates])
+        for name in properties:
+            arrays.properties[name] = [feature["properties"].get(name) for feature in features]
+        return arrays
+
+    def __len__(self):
+        return len(self.labels)
+
+    def select(self, indices):
+        ''' arrays of the features at indices
+        '''
+        arrays = FeatureArrays(self.properties)
+        arrays.labels = [self.labels[i] for i in indices]
+        arrays.scores = array('d', [self.scores[i] for i in indices])
+        arrays.lons = array('d', [self.lons[i] for i in indices])
+        arrays.lats = array('d', [self.lats[i] for i in indices])
+        arrays.properties = {name: [values[i] for i in indices] for name, values in self.properties.items()}
+        return arrays
+
+    def feature(self, index):
+        ''' rebuild a GeoJSON feature holding the extracted fields
+        '''
+        properties = {name: values[index] for name, values in self.properties.items()}
+        properties.update(label=self.labels[index], score=self.scores[index])
+        return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [self.lons[index], self.lats[index]]},
+                "properties": properties}
+
+def readCsv(content, idColumn, columns):
+    ''' return the values of columns indexed by the value of idColumn for every row of a csv answer,
+        a column missing from the answer gives empty values. The other columns are not decoded into rows
+    '''
+    reader = csv.reader(io.StringIO(content.decode('utf-8-sig')))
+    header = next(reader, [])
+    if idColumn not in header:
+        return {}
+    key = header.index(idColumn)
+    indices = [header.index(column) if column in header else None for column in columns]
+    if None not in indices:
+        return {row[key]: dict(zip(columns, [row[i] for i in indices])) for row in reader if row}
+    return {row[key]: {column: row[i] if i is not None else "" for column, i in zip(columns, indices)} for row in reader if row}
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import pyqtSignal
+
+from qgis.core import QgsTask
+
+from osgeo import ogr, osr
+import os
+
+from . import backends, settings
+from .batch import NUMERIC_COLUMNS, BatchError, closeJournal, openJournal
+
+def openInput(path, layerName=None):
+    ''' open a csv file or a layer of a GeoPackage, the first one when no name is given
+    '''
+    dataset = ogr.Open(path)
+    if dataset is None:
+        raise BatchError("Can not open {}".format(path))
+    layer = dataset.GetLayerByName(layerName) if layerName else dataset.GetLayer(0)
+    if layer is None:
+        raise BatchError("Layer {} not found in {}".format(layerName, path))
+    return dataset, layer
+
+def layerNames(path):
+    dataset, _ = openInput(path)
+    return [dataset.GetLayer(i).GetName() for i in range(dataset.GetLayerCount())]
+
+def fieldNames(path, layerName=None):
+    _, layer = openInput(path, layerName)
+    definition = layer.GetLayerDefn()
+    return [definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())]
+
+def createOutput(path, layerName, definition, columns):
+    ''' create a point layer in a GeoPackage, created if needed, with the input fields followed by the result columns.
+        An existing layer with the same name is replaced
+    '''
+    driver = ogr.GetDriverByName('GPKG')
+    dataset = driver.Open(path, 1) if os.path.exists(path) else driver.CreateDataSource(path)
+    if dataset is None:
+        raise BatchError("Can not write {}".format(path))
+    for i in range(dataset.GetLayerCount()):
+        if dataset.GetLayer(i).GetName() == layerName:
+            dataset.DeleteLayer(i)
+            break
+    crs = osr.SpatialReference()
+    crs.ImportFromEPSG(4326)
+    layer = dataset.CreateLayer(layerName, crs, ogr.wkbPoint)
+    if layer is None:
+        raise BatchError("Can not create layer {} in {}".format(layerName, path))
+    for i in range(definition.GetFieldCount()):
+        layer.CreateField(definition.GetFieldDefn(i))
+    for column in columns:
+        layer.CreateField(ogr.FieldDefn(column, ogr.OFTReal if column in NUMERIC_COLUMNS else ogr.OFTString))
+    return dataset, layer
+
+def geocodeFile(inputPath, outputPath, columns, inputLayer=None, outputLayer="geocoded", geocoder=None, chunkSize=None,
+                filterColumns=None, minScore=None, retryType=None, isCanceled=lambda: False, progress=lambda fraction: None):
+    ''' geocode a csv file or a GeoPackage layer on the address columns into a point layer of a GeoPackage.
+        Rows are streamed: only the chunk being geocoded is held in memory and every chunk is written in its own transaction.
+        The geocoder chosen in the settings is used when none is given, low score rows are sent again with the
+        {filter: column} filterColumns or the retryType. Return the number of rows written
+    '''
+    if geocoder is None:
+        geocoder = backends.fromSettings().batchGeocoder(
+            columns, chunkSize or settings.value('batch/chunkSize'), filterColumns,
+            settings.value('batch/minScore') if minScore is None else minScore,
+            settings.value('batch/retryType') if retryType is None else retryType)
+    inputDataset, source = openInput(inputPath, inputLayer)
+    definition = source.GetLayerDefn()
+    inputColumns = geocoder.inputColumns()
+    indices = [definition.GetFieldIndex(column) for column in inputColumns]
+    if -1 in indices:
+        raise BatchError("Field {} not found in {}".format(inputColumns[indices.index(-1)], inputPath))
+    total = source.GetFeatureCount()
+
+    outputDataset, output = createOutput(outputPath, outputLayer, definition, geocoder.outputColumns())
+    outputDefinition = output.GetLayerDefn()
+
+    # Input features are kept until their chunk is answered
+    pending = {}
+    def rows():
+        for rowId, feature in enumerate(source):
+            pending[rowId] = feature
+            yield rowId, [feature.GetFieldAsString(i) if feature.IsFieldSetAndNotNull(i) else '' for i in indices]
+
+    signature = dict(geocoder.signature(), input=os.path.abspath(inputPath), layer=source.GetName(),
+                     size=os.path.getsize(inputPath), modified=os.path.getmtime(inputPath))
+    journal = openJournal(signature, total)
+    count = 0
+    complete = False
+    outputDataset.StartTransaction()
+    try:
+        for rowId, result in geocoder.geocode(rows(), isCanceled, journal):
+            feature = ogr.Feature(outputDefinition)
+            feature.SetFrom(pending.pop(rowId))
+            feature.SetGeometry(None)
+            for column in geocoder.outputColumns():
+                if result[column]:
+                    feature.SetField(column, float(result[column]) if column in NUMERIC_COLUMNS else result[column])
+            if result["longitude"] and result["latitude"]:
+                point = ogr.Geometry(ogr.wkbPoint)
+                point.AddPoint_2D(float(result["longitude"]), float(result["latitude"]))
+                feature.SetGeometry(point)
+            if output.CreateFeature(feature) != ogr.OGRERR_NONE:
+                raise BatchError("Can not write to {}".format(outputPath))
+            count += 1
+            if count % geocoder.chunkSize == 0:
+                outputDataset.CommitTransaction()
+                outputDataset.StartTransaction()
+                progress(count / max(total, 1))
+        complete = not isCanceled()
+    finally:
+        outputDataset.CommitTransaction()
+        closeJournal(journal, complete)
+        outputDataset = inputDataset = None
+    progress(1.0)
+    return count
+
+class FileGeocodingTask(QgsTask):
+    ''' geocode a file in background with geocodeFile
+    '''
+
+    written = pyqtSignal(str, str, int)
+    error = pyqtSignal(str)
+
+    def __init__(self, inputPath, outputPath, columns, geocoder, inputLayer=None, outputLayer="geocoded"):
+        super().__init__("Gban - " + os.path.basename(inputPath), QgsTask.CanCancel)
+        self.inputPath = inputPath
+        self.outputPath = outputPath
+        self.columns = columns
+        self.geocoder = geocoder
+        self.inputLayer = inputLayer
+        self.outputLayer = outputLayer
+        self.count = 0
+        self.exception = None
+
+    def run(self):
+        try:
+            self.count = geocodeFile(self.inputPath, self.outputPath, self.columns, self.inputLayer, self.outputLayer,
+                                     self.geocoder, isCanceled=self.isCanceled,
+                                     progress=lambda fraction: self.setProgress(100 * fraction))
+        except (BatchError, OSError) as e:
+            self.exception = e
+            return False
+        return not self.isCanceled()
+
+    def finished(self, result):
+        if result:
+            self.written.emit(self.outputPath, self.outputLayer, self.count)
+        elif self.exception is not None:
+            self.error.emit(str(self.exception))
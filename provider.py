@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtGui import QIcon
+
+from qgis.core import QgsProcessingProvider
+
+from .algorithms import GeocodeLayerAlgorithm, IncrementalGeocodeLayerAlgorithm, ReverseGeocodeLayerAlgorithm
+import os
+
+class GbanProvider(QgsProcessingProvider):
+
+    def loadAlgorithms(self):
+        self.addAlgorithm(GeocodeLayerAlgorithm())
+        self.addAlgorithm(IncrementalGeocodeLayerAlgorithm())
+        self.addAlgorithm(ReverseGeocodeLayerAlgorithm())
+
+    def id(self):
+        return 'gban'
+
+    def name(self):
+        return 'Gban'
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(__file__), "icon.png"))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QVariant
+
+from qgis.core import QgsFeature, QgsField, QgsGeometry, QgsMarkerSymbol, QgsPointXY, QgsProject, QgsVectorLayer
+
+RESULT_FIELDS = [QgsField("label", QVariant.String), QgsField("score", QVariant.Double), QgsField("type", QVariant.String)]
+
+def memoryLayer(name, fields, geometry="Point", crs="EPSG:4326"):
+    ''' memory layer with a spatial index
+    '''
+    layer = QgsVectorLayer("{}?crs={}&index=yes".format(geometry, crs), name, "memory")
+    layer.dataProvider().addAttributes(fields)
+    layer.updateFields()
+    return layer
+
+class ResultLayer:
+    ''' layer of the project where the results of the search box are added, created again when it has been removed
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.layerId = None
+
+    def layer(self):
+        layer = QgsProject.instance().mapLayer(self.layerId) if self.layerId is not None else None
+        if layer is None:
+            layer = memoryLayer(self.name, RESULT_FIELDS)
+            layer.renderer().setSymbol(QgsMarkerSymbol.createSimple({'color': '255,0,0', 'size': '3'}))
+            QgsProject.instance().addMapLayer(layer)
+            self.layerId = layer.id()
+        return layer
+
+    def add(self, arrays):
+        ''' add the features of FeatureArrays in one call and return them
+        '''
+        layer = self.layer()
+        types = arrays.properties.get("type") or [None] * len(arrays)
+        features = []
+        for label, score, lon, lat, kind in zip(arrays.labels, arrays.scores, arrays.lons, arrays.lats, types):
+            feature = QgsFeature(layer.fields())
+            feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(lon, lat)))
+            feature.setAttributes([label, score, kind])
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        layer.updateExtents()
+        layer.triggerRepaint()
+        return features
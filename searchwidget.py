@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QCoreApplication, QModelIndex, QStringListModel, QTimer, pyqtSignal
+from qgis.PyQt.QtWidgets import QCompleter, QLineEdit
+
+from collections import OrderedDict
+import re
+
+from . import settings
+from .cache import normalize
+from .parsing import FeatureArrays
+
+# BAN rejects queries shorter than this
+MIN_LENGTH = 3
+# Decimals of the location the suggestions are biased towards (about 1 km), nearby views share their cached answers
+BIAS_PRECISION = 2
+# Maximum width in degrees of the map extent biasing the suggestions, a wider view does not tell where to look
+MAX_BIAS_EXTENT = 2.0
+
+class PrefixCache:
+    ''' in memory suggestions of the last queries. A query can also be answered from the
+        suggestions of one of its prefixes when they were complete (fewer than limit)
+    '''
+
+    def __init__(self, maxEntries=500):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+
+    def put(self, query, features, limit):
+        self.entries[normalize(query)] = (features, len(features) < limit)
+        self.entries.move_to_end(normalize(query))
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def get(self, query):
+        query = normalize(query)
+        if query in self.entries:
+            self.entries.move_to_end(query)
+            return self.entries[query][0]
+        tokens = re.findall(r'\w+', query)
+        for length in range(len(query) - 1, MIN_LENGTH - 1, -1):
+            entry = self.entries.get(query[:length])
+            if entry is not None and entry[1]:
+                features = entry[0]
+                return features.select([i for i, label in enumerate(features.labels) if self.matches(tokens, label)])
+        return None
+
+    def matches(self, tokens, label):
+        # Every token should be in the label, the last one may be incomplete
+        labelTokens = re.findall(r'\w+', normalize(label))
+        return all(token in labelTokens for token in tokens[:-1]) and \
+            any(labelToken.startswith(tokens[-1]) for labelToken in labelTokens)
+
+class SearchWidget(QLineEdit):
+    ''' address search box showing suggestions as you type.
+        Keystrokes are debounced and the request of an outdated text is aborted.
+        backend is a function returning the backend, so that it is only built on the first search,
+        location a function returning the (lon, lat) the suggestions are biased towards, or None
+    '''
+
+    resultSelected = pyqtSignal(dict)
+    failed = pyqtSignal(object)
+
+    def __init__(self, backend, parent=None, location=lambda: None):
+        super().__init__(parent)
+        self.backend = backend
+        self.location = location
+        self.handle = None
+        self.features = FeatureArrays()
+        self.cache = PrefixCache()
+        self.cacheLocation = (None, None)
+
+        self.setPlaceholderText(self.tr("Search an address"))
+        self.setClearButtonEnabled(True)
+        self.setMinimumWidth(300)
+
+        self.model = QStringListModel(self)
+        self.completer = QCompleter(self.model, self)
+        self.completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.completer.activated[QModelIndex].connect(self.select)
+        self.setCompleter(self.completer)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.search)
+        self.textEdited.connect(self.schedule)
+        self.returnPressed.connect(self.selectFirst)
+
+    def tr(self, message):
+        return QCoreApplication.translate('Gban', message)
+
+    def reset(self):
+        ''' forget the suggestions of the previous backend
+        '''
+        self.cache = PrefixCache()
+
+    def schedule(self):
+        self.abort()
+        self.timer.start(settings.value('search/debounce'))
+
+    def abort(self):
+        if self.handle is not None:
+            self.handle.abort()
+            self.handle = None
+
+    def search(self):
+        query = self.text().strip()
+        if len(query) < MIN_LENGTH:
+            self.showSuggestions(FeatureArrays())
+            return
+        params = self.biasParams()
+        location = (params.get('lon'), params.get('lat'))
+        if location != self.cacheLocation:
+            # The suggestions of another location are ranked differently
+            self.cache = PrefixCache()
+            self.cacheLocation = location
+        features = self.cache.get(query)
+        if features is not None:
+            self.showSuggestions(features)
+            return
+        limit = settings.value('search/limit')
+        self.handle = self.backend().search(query, lambda response: self.finished(query, limit, response), autocomplete=1, limit=limit,
+                                            **params)
+
+    def biasParams(self):
+        location = self.location()
+        if location is None:
+            return {}
+        return {'lon': round(location[0], BIAS_PRECISION), 'lat': round(location[1], BIAS_PRECISION)}
+
+    def finished(self, query, limit, response):
+        self.handle = None
+        try:
+            if response.error is not None:
+                raise ValueError(response.error)
+            features = FeatureArrays.fromGeoJson(response.json(), ("type",))
+        except (KeyError, ValueError):
+            self.failed.emit(response)
+            return
+        self.cache.put(query, features, limit)
+        # The text may have changed while an offline or cached answer was computed
+        if query == self.text().strip():
+            self.showSuggestions(features)
+
+    def showSuggestions(self, features):
+        self.features = features
+        self.model.setStringList(features.labels)
+        if len(features):
+            self.completer.complete()
+
+    def select(self, index):
+        if 0 <= index.row() < len(self.features):
+            self.resultSelected.emit(self.features.feature(index.row()))
+
+    def selectFirst(self):
+        if len(self.features):
+            self.completer.popup().hide()
+            self.setText(self.features.labels[0])
+            self.resultSelected.emit(self.features.feature(0))
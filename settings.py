@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QSettings
+
+from qgis.core import QgsApplication
+
+import os
+
+# Every setting is stored under the gban/ group of the QGIS settings
+DEFAULTS = {
+    'engine': 'online',
+    'offline/path': '',
+    'offline/processes': 0,
+    'batch/chunkSize': 5000,
+    'batch/reverseTolerance': 5.0,
+    'batch/journal': True,
+    'batch/minScore': 0.5,
+    'batch/retryType': '',
+    'batch/incremental': False,
+    'batch/watchEdits': False,
+    'network/url': 'https://api-adresse.data.gouv.fr',
+    'network/maxConcurrent': 4,
+    'network/rate': 10.0,
+    'network/maxRetries': 5,
+    'search/debounce': 80,
+    'search/limit': 10,
+    'search/canvasBias': True,
+    'cache/enabled': True,
+    'cache/ttlDays': 30,
+    'cache/maxEntries': 100000,
+    'cache/reversePrecision': 5,
+    'stats/log': False,
+}
+
+def value(key):
+    ''' return the stored value of a setting, or its default
+    '''
+    default = DEFAULTS[key]
+    return QSettings().value('gban/' + key, default, type=type(default))
+
+def setValue(key, value):
+    QSettings().setValue('gban/' + key, value)
+
+def profilePath(name):
+    ''' return the path of a file stored in the gban directory of the user profile
+    '''
+    path = os.path.join(QgsApplication.qgisSettingsDirPath(), 'gban', name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def offlinePath():
+    return value('offline/path') or profilePath('ban.sqlite')
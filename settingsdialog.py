@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtWidgets import QCheckBox, QComboBox, QDialog, QDialogButtonBox, QDoubleSpinBox, QFormLayout, QLabel, QLineEdit, QPushButton, QSpinBox
+
+from qgis.gui import QgsFileWidget
+
+from . import settings
+from .network import limiter
+
+class SettingsDialog(QDialog):
+
+    def __init__(self, cache, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(self.tr("Gban settings"))
+        self.cache = cache
+
+        self.engine = QComboBox(self)
+        self.engine.addItem(self.tr("BAN API"), 'online')
+        self.engine.addItem(self.tr("Offline index"), 'offline')
+        self.engine.setCurrentIndex(self.engine.findData(settings.value('engine')))
+
+        self.url = QLineEdit(settings.value('network/url'), self)
+        self.url.setPlaceholderText(settings.DEFAULTS['network/url'])
+
+        self.offlinePath = QgsFileWidget(self)
+        self.offlinePath.setStorageMode(QgsFileWidget.SaveFile)
+        self.offlinePath.setFilter(self.tr("SQLite database (*.sqlite);;Address store (*.gban)"))
+        self.offlinePath.setFilePath(settings.offlinePath())
+
+        self.processes = QSpinBox(self)
+        self.processes.setRange(0, 256)
+        self.processes.setSpecialValueText(self.tr("One per core"))
+        self.processes.setValue(settings.value('offline/processes'))
+
+        self.rate = QDoubleSpinBox(self)
+        self.rate.setRange(0, 1000)
+        self.rate.setSpecialValueText(self.tr("Unlimited"))
+        self.rate.setSuffix(self.tr(" requests/s"))
+        self.rate.setValue(settings.value('network/rate'))
+
+        self.reverseTolerance = QDoubleSpinBox(self)
+        self.reverseTolerance.setRange(0, 1000)
+        self.reverseTolerance.setSuffix(" m")
+        self.reverseTolerance.setValue(settings.value('batch/reverseTolerance'))
+
+        self.cacheEnabled = QCheckBox(self.tr("Cache results"), self)
+        self.cacheEnabled.setChecked(settings.value('cache/enabled'))
+
+        self.cacheTtl = QSpinBox(self)
+        self.cacheTtl.setRange(1, 3650)
+        self.cacheTtl.setSuffix(self.tr(" days"))
+        self.cacheTtl.setValue(settings.value('cache/ttlDays'))
+
+        self.cacheMaxEntries = QSpinBox(self)
+        self.cacheMaxEntries.setRange(100, 10000000)
+        self.cacheMaxEntries.setSingleStep(10000)
+        self.cacheMaxEntries.setValue(settings.value('cache/maxEntries'))
+
+        self.cacheStats = QLabel(self)
+        self.cacheClear = QPushButton(self.tr("Clear cache"), self)
+        self.cacheClear.clicked.connect(self.clearCache)
+        self.updateCacheStats()
+
+        self.canvasBias = QCheckBox(self.tr("Suggest the addresses near the center of the map first"), self)
+        self.canvasBias.setChecked(settings.value('search/canvasBias'))
+
+        self.logRequests = QCheckBox(self.tr("Log every request to the message log"), self)
+        self.logRequests.setChecked(settings.value('stats/log'))
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, parent=self)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+
+        layout = QFormLayout(self)
+        layout.addRow(self.tr("Geocoder"), self.engine)
+        layout.addRow(self.tr("BAN API or addok URL"), self.url)
+        layout.addRow(self.tr("Offline index"), self.offlinePath)
+        layout.addRow(self.tr("Offline batch processes"), self.processes)
+        layout.addRow(self.tr("Maximum request rate"), self.rate)
+        layout.addRow(self.tr("Batch reverse geocoding tolerance"), self.reverseTolerance)
+        layout.addRow(self.canvasBias)
+        layout.addRow(self.cacheEnabled)
+        layout.addRow(self.tr("Cache expiration"), self.cacheTtl)
+        layout.addRow(self.tr("Cache size (entries)"), self.cacheMaxEntries)
+        layout.addRow(self.cacheStats, self.cacheClear)
+        layout.addRow(self.logRequests)
+        layout.addRow(self.buttons)
+
+    def tr(self, message):
+        return QCoreApplication.translate('Gban', message)
+
+    def updateCacheStats(self):
+        self.cacheStats.setText(self.tr("{} entries, {} hits, {} misses").format(self.cache.count, self.cache.hits, self.cache.misses))
+
+    def clearCache(self):
+        self.cache.clear()
+        self.updateCacheStats()
+
+    def accept(self):
+        settings.setValue('engine', self.engine.currentData())
+        settings.setValue('network/url', self.url.text().strip() or settings.DEFAULTS['network/url'])
+        settings.setValue('offline/path', self.offlinePath.filePath())
+        settings.setValue('offline/processes', self.processes.value())
+        settings.setValue('batch/reverseTolerance', self.reverseTolerance.value())
+        settings.setValue('search/canvasBias', self.canvasBias.isChecked())
+        settings.setValue('network/rate', self.rate.value())
+        limiter.setRate(self.rate.value())
+        settings.setValue('cache/enabled', self.cacheEnabled.isChecked())
+        settings.setValue('cache/ttlDays', self.cacheTtl.value())
+        settings.setValue('cache/maxEntries', self.cacheMaxEntries.value())
+        self.cache.ttl = self.cacheTtl.value() * 86400
+        self.cache.maxEntries = self.cacheMaxEntries.value()
+        settings.setValue('stats/log', self.logRequests.isChecked())
+        super().accept()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.core import Qgis, QgsMessageLog
+
+from collections import deque
+import csv
+import json
+import re
+import threading
+import time
+
+from . import settings
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (25, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+COLUMNS = ["time", "kind", "latency_ms", "bytes", "status", "retries", "error"]
+
+def requestKind(url):
+    ''' endpoint of a request: search, reverse, search/csv, reverse/csv or offline
+    '''
+    match = re.search(r'(search|reverse)/(csv/?)?(\?|$)', url)
+    if match is None:
+        return url
+    return match.group(1) + ("/csv" if match.group(2) else "")
+
+class RequestStats:
+    ''' record the requests made by the interface and the batch threads: latency, bytes received,
+        HTTP status and retries, and count the answers found in the cache.
+        Only the last maxSamples requests are kept
+    '''
+
+    def __init__(self, maxSamples=10000):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=maxSamples)
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.count = 0
+            self.errors = 0
+            self.retries = 0
+            self.bytes = 0
+            self.cacheHits = 0
+            self.cacheMisses = 0
+            self.started = time.time()
+
+    def record(self, url, latency, size=0, status=None, retries=0, error=None):
+        sample = (time.time(), requestKind(url), latency * 1000, size, status, retries, error)
+        with self.lock:
+            self.samples.append(sample)
+            self.count += 1
+            self.errors += error is not None
+            self.retries += retries
+            self.bytes += size
+        if settings.value('stats/log'):
+            QgsMessageLog.logMessage(json.dumps(dict(zip(COLUMNS, sample))), 'Gban', Qgis.Info)
+
+    def recordCache(self, hit):
+        with self.lock:
+            if hit:
+                self.cacheHits += 1
+            else:
+                self.cacheMisses += 1
+
+    def latencies(self):
+        with self.lock:
+            return sorted(sample[2] for sample in self.samples)
+
+    def percentile(self, latencies, fraction):
+        ''' nearest rank percentile of sorted latencies
+        '''
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def histogram(self):
+        ''' number of requests in each latency bucket
+        '''
+        counts = [0] * len(BUCKETS)
+        for latency in self.latencies():
+            counts[next(i for i, bound in enumerate(BUCKETS) if latency <= bound)] += 1
+        return counts
+
+    def rate(self, window=60):
+        ''' requests per second over the last window seconds
+        '''
+        now = time.time()
+        with self.lock:
+            recent = sum(1 for sample in self.samples if sample[0] >= now - window)
+        return recent / max(1e-3, min(window, now - self.started))
+
+    def summary(self):
+        latencies = self.latencies()
+        lookups = self.cacheHits + self.cacheMisses
+        return {
+            "requests": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "bytes": self.bytes,
+            "cacheHits": self.cacheHits,
+            "cacheHitRatio": self.cacheHits / lookups if lookups else None,
+            "requestsPerSecond": self.rate(),
+            "p50": self.percentile(latencies, 0.50),
+            "p95": self.percentile(latencies, 0.95),
+            "p99": self.percentile(latencies, 0.99),
+        }
+
+    def exportCsv(self, path):
+        with self.lock:
+            samples = list(self.samples)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            writer.writerows(samples)
+
+    def exportJson(self, path):
+        with self.lock:
+            samples = [dict(zip(COLUMNS, sample)) for sample in self.samples]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"summary": self.summary(), "requests": samples}, f, indent=1)
+
+stats = RequestStats()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.PyQt.QtCore import QCoreApplication, QRectF, Qt, QTimer
+from qgis.PyQt.QtGui import QPainter
+from qgis.PyQt.QtWidgets import QFileDialog, QFormLayout, QHBoxLayout, QLabel, QMessageBox, QPushButton, QVBoxLayout, QWidget
+
+from qgis.gui import QgsDockWidget
+
+from .stats import BUCKETS, stats
+
+class HistogramWidget(QWidget):
+    ''' bars of the number of requests per latency bucket
+    '''
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.counts = [0] * len(BUCKETS)
+        self.setMinimumHeight(120)
+
+    def setCounts(self, counts):
+        self.counts = counts
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        metrics = painter.fontMetrics()
+        labelHeight = metrics.height()
+        width = self.width() / len(self.counts)
+        height = self.height() - labelHeight
+        highest = max(max(self.counts), 1)
+        for i, (count, bound) in enumerate(zip(self.counts, BUCKETS)):
+            barHeight = height * count / highest
+            painter.fillRect(QRectF(i * width + 1, height - barHeight, width - 2, barHeight), self.palette().highlight())
+            label = "≤{}".format(bound) if bound != float('inf') else ">{}".format(BUCKETS[-2])
+            painter.drawText(QRectF(i * width, height, width, labelHeight), Qt.AlignCenter, label)
+
+class StatsDock(QgsDockWidget):
+    ''' latency percentiles, throughput, cache hit ratio and latency histogram of the requests, refreshed every second
+    '''
+
+    def __init__(self, parent=None):
+        super().__init__(self.tr("Gban requests"), parent)
+        self.setObjectName("GbanStatsDock")
+
+        self.labels = {}
+        form = QFormLayout()
+        for key, title in (("requests", self.tr("Requests")), ("errors", self.tr("Errors")), ("retries", self.tr("Retries")),
+                           ("bytes", self.tr("Bytes received")), ("requestsPerSecond", self.tr("Requests/s (last minute)")),
+                           ("cacheHitRatio", self.tr("Cache hit ratio")), ("p50", self.tr("Latency p50")),
+                           ("p95", self.tr("Latency p95")), ("p99", self.tr("Latency p99"))):
+            self.labels[key] = QLabel(self)
+            form.addRow(title, self.labels[key])
+
+        self.histogram = HistogramWidget(self)
+
+        exportButton = QPushButton(self.tr("Export…"), self)
+        exportButton.clicked.connect(self.export)
+        clearButton = QPushButton(self.tr("Clear"), self)
+        clearButton.clicked.connect(self.clear)
+        buttons = QHBoxLayout()
+        buttons.addWidget(exportButton)
+        buttons.addWidget(clearButton)
+
+        widget = QWidget(self)
+        layout = QVBoxLayout(widget)
+        layout.addLayout(form)
+        layout.addWidget(QLabel(self.tr("Latency (ms)"), self))
+        layout.addWidget(self.histogram)
+        layout.addLayout(buttons)
+        layout.addStretch()
+        self.setWidget(widget)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.updateTimer)
+
+    def tr(self, message):
+        return QCoreApplication.translate('Gban', message)
+
+    def updateTimer(self, visible):
+        # Only refresh while the panel is shown
+        if visible:
+            self.refresh()
+            self.timer.start(1000)
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        summary = stats.summary()
+        for key, label in self.labels.items():
+            value = summary[key]
+            if value is None:
+                label.setText("-")
+            elif key == "cacheHitRatio":
+                label.setText("{:.1%}".format(value))
+            elif key == "requestsPerSecond":
+                label.setText("{:.2f}".format(value))
+            elif key in ("p50", "p95", "p99"):
+                label.setText("{:.0f} ms".format(value))
+            else:
+                label.setText(str(value))
+        self.histogram.setCounts(stats.histogram())
+
+    def clear(self):
+        stats.clear()
+        self.refresh()
+
+    def export(self):
+        path, selected = QFileDialog.getSaveFileName(self, self.tr("Export request statistics"), "",
+                                                     self.tr("CSV (*.csv);;JSON (*.json)"))
+        if not path:
+            return
+        try:
+            if path.lower().endswith('.json') or (selected.startswith("JSON") and not path.lower().endswith('.csv')):
+                stats.exportJson(path)
+            else:
+                stats.exportCsv(path)
+        except OSError as e:
+            QMessageBox.critical(self, self.tr("Error"), str(e))
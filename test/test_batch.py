@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+''' batch geocoding against the mock BAN API, run it with the python interpreter of QGIS from the plugin directory:
+
+        python -m unittest discover test
+'''
+
+import os
+import sys
+import unittest
+import urllib.request
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark")
+sys.path.insert(0, BENCHMARK)
+
+from mockban import MockBanServer, csvResult, parseMultipart
+from run import loadPlugin
+
+loadPlugin()
+from gban.batch import BatchError, BatchGeocoder
+
+class BatchGeocoderTest(unittest.TestCase):
+    ''' rows sent in several chunks to a server answering them in random order
+    '''
+
+    def setUp(self):
+        self.server = MockBanServer(latency=0, jitter=0, shuffle=True).start()
+        self.url = self.server.url + "/search/csv/"
+        self.chunks = 0
+
+    def tearDown(self):
+        self.server.stop()
+
+    def post(self, url, contentType, body):
+        self.chunks += 1
+        with urllib.request.urlopen(urllib.request.Request(url, body, {"Content-Type": contentType})) as response:
+            return response.read()
+
+    def rows(self):
+        # 7 distinct addresses repeated, so that duplicates fall in different chunks
+        return [(rowId, [str(rowId % 7 + 1), "rue de la Paix 63000"]) for rowId in range(50)]
+
+    def test_rows_complete_and_ordered(self):
+        geocoder = BatchGeocoder(["numero", "voie"], 3, self.url, post=self.post)
+        rows = self.rows()
+        results = list(geocoder.geocode(rows))
+        self.assertEqual([rowId for rowId, result in results], [rowId for rowId, values in rows])
+        for (rowId, values), (resultId, result) in zip(rows, results):
+            self.assertEqual(result["result_label"], csvResult(' '.join(values))["result_label"])
+        self.assertEqual(geocoder.coalescer.requests, 7)
+        self.assertEqual(self.chunks, 3)
+
+    def test_missing_row(self):
+        def truncated(url, contentType, body):
+            return b"\r\n".join(self.post(url, contentType, body).splitlines()[:-1])
+        geocoder = BatchGeocoder(["numero", "voie"], 3, self.url, post=truncated)
+        with self.assertRaises(BatchError):
+            list(geocoder.geocode(self.rows()))
+
+    def test_form_fields_of_both_passes(self):
+        forms = []
+        def recording(url, contentType, body):
+            fields, data = parseMultipart(contentType, body)
+            forms.append(([field for field in fields if field[0] != "result_columns"], data.decode('utf-8').splitlines()[0].split(',')))
+            return self.post(url, contentType, body)
+        # no score reaches 1 so that every row is sent again with the filters
+        geocoder = BatchGeocoder(["numero", "voie"], 3, self.url, post=recording, filterColumns={"citycode": "insee"},
+                                 minScore=1, retryType="housenumber", areaFilters=["postcode"])
+        list(geocoder.geocode([(0, ["1", "rue de la Paix", "63113", "63000"])]))
+        self.assertEqual(forms, [
+            ([("columns", "numero"), ("columns", "voie"), ("postcode", "gban_area_postcode")],
+             ["gban_id", "numero", "voie", "insee", "gban_area_postcode"]),
+            ([("columns", "numero"), ("columns", "voie"), ("citycode", "insee"), ("type", "gban_type")],
+             ["gban_id", "numero", "voie", "insee", "gban_area_postcode", "gban_type"])])
+
+    def test_filtered_result_kept(self):
+        def answers(url, contentType, body):
+            fields, data = parseMultipart(contentType, body)
+            rows = ["gban_id,longitude,latitude,result_label,result_score,result_citycode"]
+            for line in data.decode('utf-8').splitlines()[1:]:
+                rowId, number = line.split(',')[:2]
+                if ("citycode", "insee") in fields:
+                    # the filtered result scores lower than the first one, but for number 14
+                    rows.append("{},2.3,48.8,{} Rue de Paris Paris,{},75111".format(rowId, number, "0.8" if number == "14" else "0.7"))
+                else:
+                    rows.append("{},4.8,45.7,{} Rue de Paris Lyon,0.8,69381".format(rowId, number))
+            return "\r\n".join(rows).encode('utf-8')
+        geocoder = BatchGeocoder(["numero", "voie"], 3, self.url, post=answers, filterColumns={"citycode": "insee"}, minScore=0.9)
+        results = dict(geocoder.geocode([(0, ["12", "rue de paris", "75111"]), (1, ["12", "rue de paris", ""]),
+                                         (2, ["14", "rue de paris", ""])]))
+        # outside the citycode of the row
+        self.assertEqual((results[0]["result_citycode"], results[0]["result_quality"]), ("75111", "low"))
+        self.assertEqual(results[1]["result_citycode"], "69381")
+        # tied scores
+        self.assertEqual(results[2]["result_citycode"], "75111")
+
+if __name__ == "__main__":
+    unittest.main()
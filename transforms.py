@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Gban: geocode and reverse geocode in France using the BAN.
+# Author: Jérémy Kalsron
+#         jeremy.kalsron@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsLineString, QgsPointXY, QgsProject
+
+# Transforms of the interface, by source and destination CRS, built with the transform context of the project
+transforms = {}
+
+def crsKey(crs):
+    return crs.authid() or crs.toWkt()
+
+def transform(source, destination):
+    ''' cached transform between two CRS for the interface thread
+    '''
+    key = (crsKey(source), crsKey(destination))
+    if key not in transforms:
+        transforms[key] = QgsCoordinateTransform(source, destination, QgsProject.instance())
+    return transforms[key]
+
+def toWgs84(crs):
+    return transform(crs, QgsCoordinateReferenceSystem(4326))
+
+def fromWgs84(crs):
+    return transform(QgsCoordinateReferenceSystem(4326), crs)
+
+def clearTransforms():
+    ''' forget the cached transforms, when the transform context of the project changes
+    '''
+    transforms.clear()
+
+def transformPoints(points, transform):
+    ''' transform a list of QgsPointXY at once, the vertices of a line string are transformed as coordinate arrays
+    '''
+    if not points:
+        return []
+    line = QgsLineString([point.x() for point in points], [point.y() for point in points])
+    line.transform(transform)
+    return [QgsPointXY(x, y) for x, y in zip(line.xVector(), line.yVector())]